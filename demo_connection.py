@@ -8,60 +8,99 @@
 # Test of the communication with Thymio via serial port
 
 from thymiodirect import Connection
-from thymiodirect.assembler import Assembler
+from thymiodirect.assembler import Assembler, parse
 import serial
 import sys
+import argparse
+import asyncio
+import logging
+import logging.handlers
+import queue
 
 if __name__ == "__main__":
 
+    try:
+        # faster event loop if uvloop is installed (pip3 install uvloop)
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    # messages are logged via a queue and formatted and written to stdout
+    # in a separate thread, so that async callbacks don't wait for them
+
+    class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+        def prepare(self, record):
+            # keep message arguments as is, to be formatted by the listener
+            return record
+
+    log_queue = queue.Queue()
+    log = logging.getLogger("demo_connection")
+    log.setLevel(logging.INFO)
+    log.addHandler(DeferredQueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue,
+                                                  logging.StreamHandler(sys.stdout))
+    log_listener.start()
+
+    # program corresponding to "call leds.top(32, 32, 0) onevent button.left emit myid counter counter++"
+    src = """
+        dc end_toc                  ; total size of event handler table
+        dc _ev.init, init           ; id and address of init event
+        dc _ev.button.left, btnleft ; id and address of button.left event
+    end_toc:
+
+    init:                           ; code executed on init event
+        push.s 0                    ; initialize counter
+        store counter
+        push.s 0                    ; push address of 3rd arg, stored somewhere in free memory
+        store _userdata
+        push.s _userdata
+        push.s 32                   ; push address of 2nd arg
+        store _userdata+1
+        push.s _userdata+1
+        push.s 32                   ; push address of 1st arg
+        store _userdata+2
+        push.s _userdata+2
+        callnat _nf.leds.top        ; call native function to set top rgb led
+        stop                        ; stop program
+
+    btnleft:
+        emit myid, counter, 1       ; emit myid with current counter value
+        load counter                ; increment counter
+        push.s 1
+        add
+        store counter
+        stop
+    myid:
+        equ 0
+    counter:
+        equ _userdata+3
+    """
+    # parse once, assemble for each device
+    program = parse(src)
+
+    # bytecode assembled for each device, reused upon reconnection
+    bytecode_cache = {}
+
     async def on_connection_changed(node_id, connected):
-        print("Connection" if connected else "Disconnection", node_id)
+        log.info("%s %d", "Connection" if connected else "Disconnection", node_id)
         if connected:
             # display node information
             remote_node = th.remote_nodes[node_id]
             if remote_node.name:
-                print(f"Node name: {remote_node.name}")
+                log.info("Node name: %s", remote_node.name)
             if remote_node.device_name:
-                print(f"Device name: {remote_node.device_name}")
+                log.info("Device name: %s", remote_node.device_name)
             if remote_node.device_uuid:
-                print(f"Device uuid: {remote_node.device_uuid}")
-
-            # assemble program corresponding to "call leds.top(32, 32, 0) onevent button.left emit myid counter counter++"
-            src = """
-                dc end_toc                  ; total size of event handler table
-                dc _ev.init, init           ; id and address of init event
-                dc _ev.button.left, btnleft ; id and address of button.left event
-            end_toc:
-
-            init:                           ; code executed on init event
-                push.s 0                    ; initialize counter
-                store counter
-                push.s 0                    ; push address of 3rd arg, stored somewhere in free memory
-                store _userdata
-                push.s _userdata
-                push.s 32                   ; push address of 2nd arg
-                store _userdata+1
-                push.s _userdata+1
-                push.s 32                   ; push address of 1st arg
-                store _userdata+2
-                push.s _userdata+2
-                callnat _nf.leds.top        ; call native function to set top rgb led
-                stop                        ; stop program
-
-            btnleft:
-                emit myid, counter, 1       ; emit myid with current counter value
-                load counter                ; increment counter
-                push.s 1
-                add
-                store counter
-                stop
-            myid:
-                equ 0
-            counter:
-                equ _userdata+3
-            """
-            a = Assembler(remote_node, src)
-            bc = a.assemble()
+                log.info("Device uuid: %s", remote_node.device_uuid)
+
+            # assemble program once per device
+            key = remote_node.device_uuid or node_id
+            if key not in bytecode_cache:
+                a = Assembler(remote_node, program)
+                bytecode_cache[key] = a.assemble()
+            bc = bytecode_cache[key]
 
             # send bytecode and run it
             th.set_bytecode(node_id, bc)
@@ -71,14 +110,14 @@ if __name__ == "__main__":
         """Display prox.horizontal and quit upon button.center.
         """
         try:
-            print(f"Node {node_id}: prox.horizontal = {th[node_id]['prox.horizontal']}")
+            log.info("Node %d: prox.horizontal = %s", node_id, th[node_id]["prox.horizontal"])
             if th[node_id]["button.center"]:
                 th.shutdown()
         except KeyError:
-            print("on_variables_received", th.remote_nodes[node_id])
+            log.info("on_variables_received %s", th.remote_nodes[node_id])
 
     async def on_user_event(node_id, event_id, event_args):
-        print(f"Node {node_id}: rcv event {event_id}, value={event_args}")
+        log.info("Node %d: rcv event %d, value=%s", node_id, event_id, event_args)
 
     def run_demo(th):
         """Display information, set top rgb led to yellow,
@@ -87,28 +126,31 @@ if __name__ == "__main__":
         th.on_connection_changed = on_connection_changed
         th.on_variables_received = on_variables_received
         th.on_user_event = on_user_event
-        th.run_tasks()
-
-    use_tcp = False
-    debug = False
-    for arg in sys.argv[1:]:
-        if arg == "--tcp":
-            use_tcp = True
-        elif arg == "--debug":
-            debug = True
-        else:
-            sys.stderr.write(f"Unknown option {arg}\n")
-            exit(1)
+        try:
+            th.run_tasks()
+        except KeyboardInterrupt:
+            th.loop.run_until_complete(th.shutdown_tasks())
+
+    parser = argparse.ArgumentParser(description="Test of the communication with Thymio")
+    parser.add_argument("--tcp", action="store_true",
+                        help="connect via TCP on default local port instead of serial port")
+    parser.add_argument("--debug", action="store_true",
+                        help="display messages")
+    args = parser.parse_args()
+    use_tcp = args.tcp
+    debug = args.debug
 
     try:
         if not use_tcp:
             # try to open serial connection
-            with Connection.serial(discover_rate=2, refreshing_rate=0.5, debug=debug) as th:
+            with Connection.serial(discover_rate=2, refreshing_rate=0.5, refreshing_rate_max=2, low_latency=True, debug=debug) as th:
                 run_demo(th)
     except serial.serialutil.SerialException:
         use_tcp = True
 
     if use_tcp:
         # try TCP on default local port
-        with Connection.tcp(discover_rate=2, refreshing_rate=0.5, debug=debug) as th:
+        with Connection.tcp(discover_rate=2, refreshing_rate=0.5, refreshing_rate_max=2, debug=debug) as th:
             run_demo(th)
+
+    log_listener.stop()
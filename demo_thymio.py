@@ -9,28 +9,39 @@
 
 from thymiodirect import Thymio
 from thymiodirect.thymio_serial_ports import ThymioSerialPort
-import sys
+import argparse
+import asyncio
 import os
 import time
 
 if __name__ == "__main__":
 
+    try:
+        # faster event loop if uvloop is installed (pip3 install uvloop)
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     # check arguments
+    parser = argparse.ArgumentParser(description="Test of the communication with Thymio",
+                                     usage="%(prog)s [-h] [serial_port | host port]")
+    parser.add_argument("serial_port_or_host", nargs="?",
+                        help="serial port, or host for a TCP connection")
+    parser.add_argument("tcp_port", nargs="?", type=int,
+                        help="TCP port")
+    args = parser.parse_args()
     use_tcp = False
     serial_port = None
     host = None
     tcp_port = None
-    if len(sys.argv) == 3:
-        # tcp: argv[1] = host, argv[2] = port
+    if args.tcp_port is not None:
+        # tcp: host and port
         use_tcp = True
-        host = sys.argv[1]
-        tcp_port = int(sys.argv[2])
-    elif len(sys.argv) == 2:
-        if sys.argv[1] == "--help":
-            print("Usage: {sys.argv[0]} [serial_port | host port]")
-            sys.exit(0)
-        # serial port: argv[1] = serial port
-        serial_port = sys.argv[1]
+        host = args.serial_port_or_host
+        tcp_port = args.tcp_port
+    elif args.serial_port_or_host is not None:
+        serial_port = args.serial_port_or_host
 
     # use thymio_serial_ports for default Thymio serial port
     if not tcp_port and serial_port is None:
@@ -47,9 +58,10 @@ if __name__ == "__main__":
                     serial_port=serial_port,
                     host=host, tcp_port=tcp_port,
                     refreshing_coverage={"prox.horizontal", "button.center"},
+                    low_latency=True,
                    )
         # constructor options: on_connect, on_disconnect, on_comm_error,
-        # refreshing_rate, refreshing_coverage, discover_rate, loop
+        # refreshing_rate, refreshing_coverage, discover_rate, low_latency, loop
     except Exception as error:
         print(error)
         exit(1)
@@ -78,22 +90,32 @@ if __name__ == "__main__":
 
     # set a function called after new variable values have been fetched
     prox_prev = 0
+    leds_prev = [0, 0, 32]  # as set above
     done = False
     def obs(node_id):
-        global prox_prev, done
-        prox = (th[node_id]["prox.horizontal"][5] - th[node_id]["prox.horizontal"][2]) // 10
+        global prox_prev, leds_prev, done
+        node = th[node_id]
+        prox = (node.get("prox.horizontal", 5) - node.get("prox.horizontal", 2)) // 10
         if prox != prox_prev:
-            th[node_id]["motor.left.target"] = prox
-            th[node_id]["motor.right.target"] = prox
+            th.set_variables(node_id, {
+                "motor.left.target": prox,
+                "motor.right.target": prox,
+            })
             print(prox)
             if prox > 5:
-                th[id]["leds.top"] = [0, 32, 0]
+                leds = [0, 32, 0]
             elif prox < -5:
-                th[id]["leds.top"] = [32, 32, 0]
+                leds = [32, 32, 0]
             elif abs(prox) < 3:
-                th[id]["leds.top"] = [0, 0, 32]
+                leds = [0, 0, 32]
+            else:
+                leds = leds_prev
+            if leds != leds_prev:
+                # send leds.top only if it has changed
+                node["leds.top"] = leds
+                leds_prev = leds
             prox_prev = prox
-        if th[node_id]["button.center"]:
+        if node["button.center"]:
             print("button.center")
             done = True
 
@@ -8,38 +8,53 @@
 # Send assembly program to Thymio
 
 from thymiodirect import Connection
-from thymiodirect.assembler import Assembler
+from thymiodirect.assembler import Assembler, parse
 import serial
 import sys
-import os
+import argparse
+import asyncio
 
 if __name__ == "__main__":
 
-    asm = None
-    use_tcp = False
-    debug = False
-    for arg in sys.argv[1:]:
-        if arg == "--tcp":
-            use_tcp = True
-        elif arg == "--debug":
-            debug = True
-        elif arg[0:2] == "--" or asm:
-            print(f"Usage: python3 {sys.argv[0]} [--tcp] [program.asm]")
-            exit(1)
-        else:
-            with open(arg, 'r') as file:
-                asm = file.read()
-    if asm is None:
+    try:
+        # faster event loop if uvloop is installed (pip3 install uvloop)
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    parser = argparse.ArgumentParser(description="Send assembly program to Thymio")
+    parser.add_argument("--tcp", action="store_true",
+                        help="connect via TCP on default local port instead of serial port")
+    parser.add_argument("--debug", action="store_true",
+                        help="display messages")
+    parser.add_argument("program", nargs="?",
+                        help="assembly source file (default: stdin)")
+    args = parser.parse_args()
+    use_tcp = args.tcp
+    debug = args.debug
+    if args.program:
+        with open(args.program, 'r') as file:
+            asm = file.read()
+    else:
         asm = sys.stdin.read()
+    # parse once, assemble for each device
+    program = parse(asm)
 
     code_sent = False
 
+    # bytecode assembled for each device, reused upon reconnection
+    bytecode_cache = {}
+
     async def on_connection_changed(node_id, connected):
         if connected:
-            # assemble program
+            # assemble program once per device
             remote_node = th.remote_nodes[node_id]
-            a = Assembler(remote_node, asm)
-            bc = a.assemble()
+            key = remote_node.device_uuid or node_id
+            if key not in bytecode_cache:
+                a = Assembler(remote_node, program)
+                bytecode_cache[key] = a.assemble()
+            bc = bytecode_cache[key]
 
             # send bytecode and run it
             th.set_bytecode(node_id, bc)
@@ -49,28 +64,26 @@ if __name__ == "__main__":
 
     async def on_execution_state_changed(node_id, pc, flags):
         if code_sent:
-            os._exit(0) # forced exit despite coroutines
+            # done: stop the tasks so that run_tasks() returns
+            await th.shutdown_tasks()
 
     def run_until_executed(th):
         th.on_connection_changed = on_connection_changed
         th.on_execution_state_changed = on_execution_state_changed
         try:
-            th.run_forever()
+            th.run_tasks()
         except KeyboardInterrupt:
-            th.shutdown()
-            th.run_forever()
-            th.close()
-
+            th.loop.run_until_complete(th.shutdown_tasks())
 
     try:
         if not use_tcp:
             # try to open serial connection
-            with Connection.serial(discover_rate=2, refreshing_rate=0.5, debug=debug) as th:
+            with Connection.serial(discover_rate=2, refreshing_rate=0.5, refreshing_rate_max=2, low_latency=True, debug=debug) as th:
                 run_until_executed(th)
     except serial.serialutil.SerialException:
         use_tcp = True
 
     if use_tcp:
         # try TCP on default local port
-        with Connection.tcp(discover_rate=2, refreshing_rate=0.5, debug=debug) as th:
+        with Connection.tcp(discover_rate=2, refreshing_rate=0.5, refreshing_rate_max=2, debug=debug) as th:
             run_until_executed(th)
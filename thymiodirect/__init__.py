@@ -43,22 +43,23 @@ th[id]["leds.top"] = [0, 0, 32]
 prox_prev = 0
 def obs(node_id):
     global prox_prev
-    prox = (th[node_id]["prox.horizontal"][5]
-            - th[node_id]["prox.horizontal"][2]) // 10
+    node = th[node_id]
+    prox_horizontal = node["prox.horizontal"]
+    prox = (prox_horizontal[5] - prox_horizontal[2]) // 10
     if prox != prox_prev:
-        th[node_id]["motor.left.target"] = prox
-        th[node_id]["motor.right.target"] = prox
+        node["motor.left.target"] = prox
+        node["motor.right.target"] = prox
         print(prox)
         if prox > 5:
-            th[id]["leds.top"] = [0, 32, 0]
+            node["leds.top"] = [0, 32, 0]
         elif prox < -5:
-            th[id]["leds.top"] = [32, 32, 0]
+            node["leds.top"] = [32, 32, 0]
         elif abs(prox) < 3:
-            th[id]["leds.top"] = [0, 0, 32]
+            node["leds.top"] = [0, 0, 32]
         prox_prev = prox
-    if th[node_id]["button.center"]:
+    if node["button.center"]:
         print("button.center")
-        os._exit(0) # forced exit despite coroutines
+        th.disconnect()
 
 # install this function
 th.set_variable_observer(id, obs)
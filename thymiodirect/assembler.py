@@ -11,389 +11,472 @@ Author: Yves Piguet, EPFL
 """
 
 import thymiodirect
+import array
 import re
-from typing import Callable, Dict, List, Union
+import sys
+import weakref
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# parsed source line: (line number, label, instruction name, arguments)
+ParsedLine = Tuple[int, Optional[str], Optional[str], List[Union[int, str]]]
+
+# line stripped of leading and trailing white space: label, instruction
+# name and arguments, each optional, then comment
+_re_line = re.compile(r"^(?:([\w_.]+):)?\s*(?:([a-z0-9.]+)([-a-zA-Z0-9\s._,+=]*))?(;.*)?$")
+_re_number = re.compile(r"^(-?[0-9]+|0x[0-9a-fA-F]+)$")
+_number_start = frozenset("-0123456789")  # first char of numbers
+_re_arg = re.compile(r"[^\s,]+")
+_re_def_number = re.compile(r"^(0x[0-9a-f]+|[0-9]+)$", re.I)
+_re_symbol_token = re.compile(r"(\+|-|[._a-z0-9]+)", re.I)
+
+# definitions of each remote node: (key, defs) by RemoteNode, where key
+# changes when the node description does
+_node_definitions = weakref.WeakKeyDictionary()
+
+
+class _UnknownSymbol(Exception):
+    """Symbol not defined (yet).
+    """
+    pass
+
+
+def parse(src: str) -> List[ParsedLine]:
+    """Parse assembly source code to a list of (line number, label,
+    instruction name, arguments) tuples. Blank lines and comments are
+    skipped; instruction name is None for lines with just a label.
+    The result can be passed to Assembler instead of the source code
+    to assemble the same program for multiple nodes.
+    """
+
+    line_match = _re_line.match
+    number_match = _re_number.match
+    args_findall = _re_arg.findall
+
+    parsed = []
+    for i, line in enumerate(src.split("\n")):
+        line = line.strip()
+        if not line or line[0] == ";":
+            # blank or comment (ignore)
+            continue
+
+        r = line_match(line)
+        if r:
+            if r[2] is None:
+                # label without instr
+                parsed.append((i + 1, r[1], None, []))
+                continue
+            label = r[1]
+            instr_name = sys.intern(r[2])
+            # arguments separated by commas and/or spaces
+            args = [
+                int(a, 0) if a[0] in _number_start and number_match(a) else a
+                for a in args_findall(r[3])
+            ]
+            parsed.append((i + 1, label, instr_name, args))
+            continue
+
+        print("line", line)
+        raise Exception(f"Syntax error (line {i+1})")
+
+    return parsed
+
+
+def _instruction_tables() -> Tuple[Dict[str, Dict], Dict[str, int],
+                                   Dict[str, array.array],
+                                   Dict[str, Callable]]:
+    """Create the tables of instructions shared by all Assembler objects:
+    instruction descriptions, comparison opcodes, fixed code and encoders.
+    """
+
+    instr_table = {
+        "dc": {
+            "num_args": -1
+        },
+        "equ": {
+            "num_args": 1
+        },
+        "stop": {
+            "code": [0x0000]
+        },
+        "push.s": {
+            "num_args": 1
+        },
+        "push": {
+            "num_args": 1
+        },
+        "load": {
+            "num_args": 1
+        },
+        "store": {
+            "num_args": 1
+        },
+        "load.ind": {
+            "num_args": 2
+        },
+        "store.ind": {
+            "num_args": 2
+        },
+        "neg": {
+            "code": [0x7000]
+        },
+        "abs": {
+            "code": [0x7001]
+        },
+        "bitnot": {
+            "code": [0x7002]
+        },
+        "not": {
+            # empty
+        },
+        "sl": {
+            "code": [0x8000]
+        },
+        "asr": {
+            "code": [0x8001]
+        },
+        "add": {
+            "code": [0x8002]
+        },
+        "sub": {
+            "code": [0x8003]
+        },
+        "mult": {
+            "code": [0x8004]
+        },
+        "div": {
+            "code": [0x8005]
+        },
+        "mod": {
+            "code": [0x8006]
+        },
+        "bitor": {
+            "code": [0x8007]
+        },
+        "bitxor": {
+            "code": [0x8008]
+        },
+        "bitand": {
+            "code": [0x8009]
+        },
+        "eq": {
+            "code": [0x800a]
+        },
+        "ne": {
+            "code": [0x800b]
+        },
+        "gt": {
+            "code": [0x800c]
+        },
+        "ge": {
+            "code": [0x800d]
+        },
+        "lt": {
+            "code": [0x800e]
+        },
+        "le": {
+            "code": [0x800f]
+        },
+        "or": {
+            "code": [0x8010]
+        },
+        "and": {
+            "code": [0x8011]
+        },
+        "jump": {
+            "num_args": 1
+        },
+        "jump.if.not": {
+            "num_args": 2
+        },
+        "do.jump.when.not": {
+            "num_args": 2
+        },
+        "dont.jump.when.not": {
+            "num_args": 2
+        },
+        "emit": {
+            "num_args": 3
+        },
+        "callnat": {
+            "num_args": 1
+        },
+        "callsub": {
+            "num_args": 1
+        },
+        "ret": {
+            "code": [0xe000]
+        },
+    }
+
+    # comparison operators for conditional jumps: opcode low byte by name
+    cmp_opcode = {
+        name: instr["code"][0] & 0xff
+        for name, instr in instr_table.items()
+        if ("code" in instr
+            and len(instr["code"]) == 1
+            and (instr["code"][0] & 0xf000) == 0x8000)
+    }
+
+    def resolve_symbol(a, defs: Dict[str, int], required: bool) -> int:
+        if type(a) is str:
+            # eval
+            tokens = _re_symbol_token.findall(a)
+            if sum(map(len, tokens)) != len(a):
+                # characters skipped by findall
+                raise Exception("Syntax error")
+            val = 0
+            minus = False
+            for s in tokens:
+                if s == "+":
+                    minus = False
+                elif s == "-":
+                    minus = True
+                else:
+                    if not required:
+                        v = 0
+                    elif s[0] in _number_start and _re_def_number.match(s):
+                        v = int(s, 0)
+                    else:
+                        v = defs.get(s)
+                        if v is None:
+                            raise _UnknownSymbol(f'Unknown symbol "{s}"')
+                    val += -v if minus else v
+            return val
+
+        return a
+
+    def def_to_code(instr: str) -> Callable:
+        def register(fun):
+            instr_table[instr]["to_code"] = fun
+            return fun
+        return register
+
+    @def_to_code("dc")
+    def to_code_dc(pc: int, args: List[Union[int, str]], label: str, defs: Dict[str, int], phase: int, line: int) -> List[int]:
+        return [
+            resolve_symbol(a, defs, phase == 1) & 0xffff
+            for a in args
+        ]
+
+    @def_to_code("equ")
+    def to_code_equ(pc, args, label, defs, phase, line):
+        if label is None:
+            raise Exception(f'No label for pseudo-instruction "equ" (line {line})')
+        if defs is not None:
+            defs[label] = resolve_symbol(args[0], defs, phase == 1)
+            label = None
+        return []
+
+    @def_to_code("push.s")
+    def to_code_push_s(pc, args, label, defs, phase, line):
+        arg = resolve_symbol(args[0], defs, phase == 1)
+        if (arg + 0x1000) & ~0x1fff:
+            # not in [-0x1000, 0x1000)
+            raise Exception(f"Small integer overflow (line {line})")
+        return [0x1000 | arg & 0xfff]
+
+    @def_to_code("push")
+    def to_code_push(pc, args, label, defs, phase, line):
+        arg = resolve_symbol(args[0], defs, phase == 1)
+        return [0x2000, arg & 0xffff]
+
+    def check_imm12(arg: int, error: str, line: int) -> int:
+        # unsigned 12-bit address or id in an instruction word
+        if arg & ~0xfff:
+            # not in [0, 0x1000)
+            raise Exception(f"{error} (line {line})")
+        return arg
+
+    def def_imm12(instr: str, code: int, error: str) -> None:
+        @def_to_code(instr)
+        def to_code_imm12(pc, args, label, defs, phase, line):
+            arg = resolve_symbol(args[0], defs, phase == 1)
+            return [code | check_imm12(arg, error, line)]
+
+    def def_imm12_size(instr: str, code: int) -> None:
+        # data address, then size
+        @def_to_code(instr)
+        def to_code_imm12_size(pc, args, label, defs, phase, line):
+            arg = resolve_symbol(args[0], defs, phase == 1)
+            size_arg = resolve_symbol(args[1], defs, phase == 1)
+            return [code | check_imm12(arg, "Data address out of range", line),
+                    size_arg & 0xffff]
+
+    def_imm12("load", 0x3000, "Data address out of range")
+    def_imm12("store", 0x4000, "Data address out of range")
+    def_imm12_size("load.ind", 0x5000)
+    def_imm12_size("store.ind", 0x6000)
+    def_imm12("callnat", 0xc000, "Native call id out of range")
+    def_imm12("callsub", 0xd000, "Subroutine address out of range")
+
+    @def_to_code("not")
+    def to_code_not(pc, args, label, defs, phase, line):
+        raise Exception(f'Unary "not" not implemented in the VM (line {line})')
+
+    @def_to_code("jump")
+    def to_code_jump(pc, args, label, defs, phase, line):
+        arg = resolve_symbol(args[0], defs, phase == 1)
+        return [0x9000 | (arg - pc) & 0xfff]
+
+    def def_cond_jump(instr: str, code: int) -> None:
+        @def_to_code(instr)
+        def to_code_cond_jump(pc, args, label, defs, phase, line):
+            test_opcode = cmp_opcode.get(args[0])
+            if test_opcode is None:
+                raise Exception(f'Unknown op "{args[0]}" for {instr} (line {line})')
+            arg = resolve_symbol(args[1], defs, phase == 1)
+            return [code | test_opcode, (arg - pc) & 0xffff]
+
+    def_cond_jump("jump.if.not", 0xa000)
+    def_cond_jump("do.jump.when.not", 0xa100)
+    def_cond_jump("dont.jump.when.not", 0xa300)
+
+    @def_to_code("emit")
+    def to_code_emit(pc, args, label, defs, phase, line):
+        event_id = resolve_symbol(args[0], defs, phase == 1)
+        addr = resolve_symbol(args[1], defs, phase == 1)
+        size = resolve_symbol(args[2], defs, phase == 1)
+        return [0xb000 | check_imm12(event_id, "Event id out of range", line),
+                addr & 0xffff,
+                size & 0xffff]
+
+    # dispatch tables for assemble(): fixed code or encoder
+    instr_code = {
+        name: array.array("H", instr["code"])
+        for name, instr in instr_table.items()
+        if "code" in instr
+    }
+    instr_to_code = {
+        name: instr["to_code"]
+        for name, instr in instr_table.items()
+        if "to_code" in instr
+    }
+
+    return instr_table, cmp_opcode, instr_code, instr_to_code
+
+
+_instr, _cmp_opcode, _instr_code, _instr_to_code = _instruction_tables()
 
 
 class Assembler:
 
-    def __init__(self, remote_node: thymiodirect.connection.RemoteNode, src: str):
+    def __init__(self, remote_node: thymiodirect.connection.RemoteNode,
+                 src: Union[str, List[ParsedLine]]):
         """
         Construct a new Assembler object.
 
         Args:
             remote_node: Remote node used to predefine constants.
-            src: Assembly source code.
+            src: Assembly source code, or its parsed form as returned by
+                parse(src).
         """
 
         self.remote_node = remote_node
         self.src = src
 
-        self.instr = {
-            "dc": {
-                "num_args": -1
-            },
-            "equ": {
-                "num_args": 1
-            },
-            "stop": {
-                "code": [0x0000]
-            },
-            "push.s": {
-                "num_args": 1
-            },
-            "push": {
-                "num_args": 1
-            },
-            "load": {
-                "num_args": 1
-            },
-            "store": {
-                "num_args": 1
-            },
-            "load.ind": {
-                "num_args": 2
-            },
-            "store.ind": {
-                "num_args": 2
-            },
-            "neg": {
-                "code": [0x7000]
-            },
-            "abs": {
-                "code": [0x7001]
-            },
-            "bitnot": {
-                "code": [0x7002]
-            },
-            "not": {
-                # empty
-            },
-            "sl": {
-                "code": [0x8000]
-            },
-            "asr": {
-                "code": [0x8001]
-            },
-            "add": {
-                "code": [0x8002]
-            },
-            "sub": {
-                "code": [0x8003]
-            },
-            "mult": {
-                "code": [0x8004]
-            },
-            "div": {
-                "code": [0x8005]
-            },
-            "mod": {
-                "code": [0x8006]
-            },
-            "bitor": {
-                "code": [0x8007]
-            },
-            "bitxor": {
-                "code": [0x8008]
-            },
-            "bitand": {
-                "code": [0x8009]
-            },
-            "eq": {
-                "code": [0x800a]
-            },
-            "ne": {
-                "code": [0x800b]
-            },
-            "gt": {
-                "code": [0x800c]
-            },
-            "ge": {
-                "code": [0x800d]
-            },
-            "lt": {
-                "code": [0x800e]
-            },
-            "le": {
-                "code": [0x800f]
-            },
-            "or": {
-                "code": [0x8010]
-            },
-            "and": {
-                "code": [0x8011]
-            },
-            "jump": {
-                "num_args": 1
-            },
-            "jump.if.not": {
-                "num_args": 2
-            },
-            "do.jump.when.not": {
-                "num_args": 2
-            },
-            "dont.jump.when.not": {
-                "num_args": 2
-            },
-            "emit": {
-                "num_args": 3
-            },
-            "callnat": {
-                "num_args": 1
-            },
-            "callsub": {
-                "num_args": 1
-            },
-            "ret": {
-                "code": [0xe000]
-            },
-        }
-
-        def resolve_symbol(a, defs: Dict[str, int], required: bool) -> int:
-
-            def resolve_def(name: str) -> int:
-                if not required:
-                    return 0
-                if re.match("^(0x[0-9a-f]+|[0-9]+)$", name, flags=re.I):
-                    return int(name, 0)
-                if name not in defs:
-                    raise Exception(f'Unknown symbol "{name}"')
-                return defs[name]
-
-            if type(a) is str:
-                # eval
-                val = 0
-                minus = False
-                offset = 0
-                while offset < len(a):
-                    r = re.match(r"(\+|-|[._a-z0-9]+)", a[offset:], re.I)
-                    if r is None:
-                        raise Exception("Syntax error")
-                    s = r.group()
-                    if s == "+":
-                        minus = False
-                    elif s == "-":
-                        minus = True
-                    else:
-                        val += -resolve_def(s) if minus else resolve_def(s)
-                    offset += len(s)
-                return val
-
-            return a
-
-        def def_to_code(instr: str) -> Callable:
-            def register(fun):
-                self.instr[instr]["to_code"] = fun
-                return fun
-            return register
-
-        @def_to_code("dc")
-        def to_code_dc(pc: int, args: List[Union[int, str]], label: str, defs: Dict[str, int], phase: int, line: int) -> List[int]:
-            return [
-                resolve_symbol(a, defs, phase == 1) & 0xffff
-                for a in args
-            ]
-
-        @def_to_code("equ")
-        def to_code_equ(pc, args, label, defs, phase, line):
-            if label is None:
-                raise Exception(f'No label for pseudo-instruction "equ" (line {line})')
-            if defs is not None:
-                defs[label] = resolve_symbol(args[0], defs, phase == 1)
-                label = None
-            return []
+        self.instr = _instr
+        self.cmp_opcode = _cmp_opcode
+        self.instr_code = _instr_code
+        self.instr_to_code = _instr_to_code
 
-        @def_to_code("push.s")
-        def to_code_push_s(pc, args, label, defs, phase, line):
-            arg = resolve_symbol(args[0], defs, phase == 1)
-            if arg >= 0x1000 or -arg > 0x1000:
-                raise Exception(f"Small integer overflow (line {line})")
-            return [0x1000 | arg & 0xfff]
-
-        @def_to_code("push")
-        def to_code_push(pc, args, label, defs, phase, line):
-            arg = resolve_symbol(args[0], defs, phase == 1)
-            return [0x2000, arg & 0xffff]
-
-        @def_to_code("load")
-        def to_code_load(pc, args, label, defs, phase, line):
-            arg = resolve_symbol(args[0], defs, phase == 1)
-            if arg < 0 or arg >= 0x1000:
-                raise Exception(f"Data address out of range (line {line})")
-            return [0x3000 | arg & 0xfff]
-
-        @def_to_code("store")
-        def to_code_store(pc, args, label, defs, phase, line):
-            arg = resolve_symbol(args[0], defs, phase == 1)
-            if arg < 0 or arg >= 0x1000:
-                raise Exception(f"Data address out of range (line {line})")
-            return [0x4000 | arg & 0xfff]
-
-        @def_to_code("load.ind")
-        def to_code_load_ind(pc, args, label, defs, phase, line):
-            arg = resolve_symbol(args[0], defs, phase == 1)
-            if arg < 0 or arg >= 0x1000:
-                raise Exception(f"Data address out of range (line {line})")
-            size_arg = resolve_symbol(args[1], defs, phase == 1)
-            return [0x5000 | arg & 0xfff, size_arg & 0xffff]
-
-        @def_to_code("store.ind")
-        def to_code_store_ind(pc, args, label, defs, phase, line):
-            arg = resolve_symbol(args[0], defs, phase == 1)
-            if arg < 0 or arg >= 0x1000:
-                raise Exception(f"Data address out of range (line {line})")
-            size_arg = resolve_symbol(args[1], defs, phase == 1)
-            return [0x6000 | arg & 0xfff, size_arg & 0xffff]
-
-        @def_to_code("not")
-        def to_code_not(pc, args, label, defs, phase, line):
-            raise Exception(f'Unary "not" not implemented in the VM (line {line})')
-
-        @def_to_code("jump")
-        def to_code_jump(pc, args, label, defs, phase, line):
-            arg = resolve_symbol(args[0], defs, phase == 1)
-            return [0x9000 | (arg - pc) & 0xfff]
-
-        @def_to_code("jump.if.not")
-        def to_code_jump_if_not(pc, args, label, defs, phase, line):
-            test_instr = self.instr[args[0]] if args[0] in self.instr else None
-            if (test_instr is None
-                or "code" not in test_instr
-                or len(test_instr["code"]) != 1
-                or (test_instr["code"][0] & 0xf000) != 0x8000):
-                raise Exception(f'Unknown op "{args[0]}" for jump.if.not (line {line})')
-            arg = resolve_symbol(args[1], defs, phase == 1)
-            return [0xa000 | (test_instr["code"][0] & 0xff), (arg - pc) & 0xffff]
-
-        @def_to_code("do.jump.when.not")
-        def to_code_do_jump_when_not(pc, args, label, defs, phase, line):
-            test_instr = self.instr[args[0]] if args[0] in self.instr else None
-            if (test_instr is None
-                or "code" not in test_instr
-                or len(test_instr["code"]) != 1
-                or (test_instr["code"][0] & 0xf000) != 0x8000):
-                raise Exception(f'Unknown op "{args[0]}" for do.jump.when.not (line {line})')
-            arg = resolve_symbol(args[1], defs, phase == 1)
-            return [0xa100 | (test_instr["code"][0] & 0xff), (arg - pc) & 0xffff]
-
-        @def_to_code("dont.jump.when.not")
-        def to_code_dont_jump_when_not(pc, args, label, defs, phase, line):
-            test_instr = self.instr[args[0]] if args[0] in self.instr else None
-            if (test_instr is None
-                or "code" not in test_instr
-                or len(test_instr["code"]) != 1
-                or (test_instr["code"][0] & 0xf000) != 0x8000):
-                raise Exception(f'Unknown op "{args[0]}" for dont.jump.when.not (line {line})')
-            arg = resolve_symbol(args[1], defs, phase == 1)
-            return [0xa300 | (test_instr["code"][0] & 0xff), (arg - pc) & 0xffff]
-
-        @def_to_code("emit")
-        def to_code_emit(pc, args, label, defs, phase, line):
-            id = resolve_symbol(args[0], defs, phase == 1)
-            if id < 0 or id >= 0x1000:
-                raise Exception(f"Event id out of range (line {line})")
-            addr = resolve_symbol(args[1], defs, phase == 1)
-            size = resolve_symbol(args[2], defs, phase == 1)
-            return [0xb000 | id & 0xfff, addr & 0xffff, size & 0xffff]
-
-        @def_to_code("callnat")
-        def to_code_callnat(pc, args, label, defs, phase, line):
-            arg = resolve_symbol(args[0], defs, phase == 1)
-            if arg < 0 or arg >= 0x1000:
-                raise Exception(f"Native call id out of range (line {line})")
-            return [0xc000 | arg & 0xfff]
-
-        @def_to_code("callsub")
-        def to_code_callsub(pc, args, label, defs, phase, line):
-            arg = resolve_symbol(args[0], defs, phase == 1)
-            if arg < 0 or arg >= 0x1000:
-                raise Exception(f"Subroutine address out of range (line {line})")
-            return [0xd000 | arg & 0xfff]
-
-    def node_definitions(self) -> None:
+    def node_definitions(self) -> Dict[str, int]:
         """Create definition dict based on node variables and native functions.
+        The definitions are computed once per remote node and copied.
         """
 
-        defs = {}
+        node = self.remote_node
+        key = (
+            len(node.named_variables),
+            node.var_total_size,
+            node.max_var_size,
+            len(node.local_events),
+            len(node.native_functions),
+        )
+        cached = _node_definitions.get(node)
+        if cached is not None and cached[0] == key:
+            return dict(cached[1])
 
         # variables
-        for name in self.remote_node.named_variables:
-            defs[name] = self.remote_node.var_offset[name]
-        defs["_userdata"] = self.remote_node.var_total_size
-        defs["_topdata"] = self.remote_node.max_var_size
+        defs = {name: node.var_offset[name] for name in node.named_variables}
+        defs["_userdata"] = node.var_total_size
+        defs["_topdata"] = node.max_var_size
 
         # local events
         defs["_ev.init"] = 0xffff
-        for i in range(len(self.remote_node.local_events)):
-            defs["_ev." + self.remote_node.local_events[i]] = 0xfffe - i
+        defs.update(("_ev." + name, 0xfffe - i)
+                    for i, name in enumerate(node.local_events))
 
         # native functions
-        for i in range(len(self.remote_node.native_functions)):
-            defs["_nf." + self.remote_node.native_functions[i]] = i
+        defs.update(("_nf." + name, i)
+                    for i, name in enumerate(node.native_functions))
 
-        return defs
+        _node_definitions[node] = (key, defs)
+        return dict(defs)
 
-    def assemble(self) -> List[int]:
-        """Assemble to bytecode.
+    def assemble(self) -> array.array:
+        """Assemble to bytecode, an array of unsigned 16-bit words
+        (array.array("H")).
         """
 
-        lines = self.src.split("\n")
+        lines = parse(self.src) if isinstance(self.src, str) else self.src
         defs = self.node_definitions()
-
-        re_blank = re.compile(r"^\s*(;.*)?$")
-        re_label = re.compile(r"^\s*([\w_.]+:)\s*(;.*)?$")
-        re_instr = re.compile(r"^\s*([\w_.]+:)?\s*([a-z0-9.]+)([-a-zA-Z0-9\s._,+=]*)(;.*)?$")
-        re_number = re.compile(r"^(-?[0-9]+|0x[0-9a-fA-F]+)$")
-
-        for phase in (0, 1):
-            bytecode = []
-            label = None
-            for i, line in enumerate(lines):
-                if re_blank.match(line):
-                    # blank or comment (ignore)
-                    continue
-
-                r = re_label.match(line)
-                if r:
-                    # label without instr
-                    label = r[1][0:-1]
-                    defs[label] = len(bytecode)
-                    continue
-
-                r = re_instr.match(line)
-                if r:
-                    if r[1]:
-                        label = r[1][0:-1]
-                        defs[label] = len(bytecode)
-                    instr_name = r[2]
-                    instr_args = r[3].strip()
-                    if instr_name:
-                        if len(instr_args) > 0:
-                            args_split = [
-                                a.strip()
-                                for a1 in instr_args.split(",")
-                                for a in a1.strip().split()
-                            ]
-                        else:
-                            args_split = []
-
-                    if instr_name not in self.instr:
-                        raise Exception(f"Unknown instruction {instr_name} (line {i+1})")
-                    instr = self.instr[instr_name]
-                    if "code" in instr:
-                        bytecode += instr["code"]
-                    elif "to_code" in instr:
-                        args = [
-                            int(a, 0) if re_number.match(a) else a
-                            for a in args_split
-                        ]
-                        bytecode += instr["to_code"](len(bytecode), args, label, defs, phase, i + 1)
-                    if label is not None and defs[label] != len(bytecode):
+        instr_code = self.instr_code
+        instr_to_code = self.instr_to_code
+
+        # single pass: code which refers to symbols defined further is
+        # emitted with zeros and fixed once all symbols are known
+        bytecode = array.array("H")
+        fixups_equ = []  # (pc, args, label, line) of equ
+        fixups = []  # (pc, to_code, args, label, line)
+        label = None
+        for line, line_label, instr_name, args in lines:
+            if line_label is not None:
+                label = line_label
+                defs[label] = len(bytecode)
+            if instr_name is None:
+                # label without instr
+                continue
+
+            code = instr_code.get(instr_name)
+            if code is not None:
+                bytecode.extend(code)
+            else:
+                to_code = instr_to_code.get(instr_name)
+                if to_code is None:
+                    raise Exception(f"Unknown instruction {instr_name} (line {line})")
+                pc = len(bytecode)
+                try:
+                    bytecode.extend(to_code(pc, args, label, defs, 1, line))
+                except _UnknownSymbol:
+                    if instr_name == "equ":
+                        # undefined until fixed, so that it's fixed in code too
+                        del defs[label]
+                        fixups_equ.append((pc, args, label, line))
                         label = None
-                    continue
+                        continue
+                    # placeholder of the right size (symbols resolved as 0)
+                    bytecode.extend(to_code(pc, args, label, defs, 0, line))
+                    fixups.append((pc, to_code, args, label, line))
+            if label is not None and defs[label] != len(bytecode):
+                label = None
 
-                print("line", line)
-                raise Exception(f"Syntax error (line {i+1})")
+        # equ can refer to symbols defined by other equ: resolve them until
+        # no more progress can be made
+        while len(fixups_equ) > 0:
+            pending = []
+            for fixup in fixups_equ:
+                try:
+                    instr_to_code["equ"](*fixup[0:3], defs, 1, fixup[3])
+                except _UnknownSymbol:
+                    pending.append(fixup)
+            if len(pending) == len(fixups_equ):
+                # raise exception for first unresolved symbol
+                pc, args, label, line = pending[0]
+                instr_to_code["equ"](pc, args, label, defs, 1, line)
+            fixups_equ = pending
+        for pc, to_code, args, label, line in fixups:
+            code = to_code(pc, args, label, defs, 1, line)
+            bytecode[pc:pc + len(code)] = array.array("H", code)
 
         return bytecode
 
@@ -10,12 +10,40 @@ Communication with Thymio via serial port or tcp
 Author: Yves Piguet, EPFL
 """
 
+import array
 import asyncio
+import collections
+import collections.abc
+import contextlib
+import selectors
+import struct
+import sys
 import threading
 import time
-from typing import Awaitable, Callable, List, Optional, Set, Tuple
+from typing import Awaitable, Callable, List, Optional, Sequence, Set, Tuple
 
-from thymiodirect.message import Message
+from thymiodirect.message import Message, _header
+
+# header and payload start of SET_VARIABLES (and SET_BYTECODE): target node
+# id and offset
+_set_variables_header = struct.Struct("<HHHHH")
+
+
+def _int16(val: int) -> int:
+    """Convert a signed or unsigned 16-bit number to signed.
+    """
+    return ((val + 0x8000) & 0xffff) - 0x8000
+
+
+def _is_array(val) -> bool:
+    """Check whether a value to be assigned to a variable is an array
+    (list, tuple, array.array, numpy array etc.) rather than a number.
+    Strings and bytes aren't arrays.
+    """
+    if isinstance(val, (str, bytes, bytearray)):
+        return False
+    # numpy arrays aren't registered as sequences
+    return isinstance(val, collections.abc.Sequence) or getattr(val, "ndim", 0) > 0
 
 
 class InputThread(threading.Thread):
@@ -29,54 +57,244 @@ class InputThread(threading.Thread):
         self.loop = loop
         self.handle_msg = handle_msg
         self.comm_error = None
+        self.buffer = bytearray()  # input read but not decoded yet
+
+        # wait for input with a selector if io has a file descriptor, so that
+        # reading never blocks without timeout (e.g. sockets)
+        self.selector = None
+        self.select_timeout = 1
+        try:
+            fd = io.fileno()
+        except (AttributeError, OSError, ValueError):
+            fd = None
+        if fd is not None:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(fd, selectors.EVENT_READ)
 
     def terminate(self, on_terminated=None) -> None:
         self.on_terminated = on_terminated
         self.running = False
 
-    def read_uint16(self) -> int:
-        """Read an unsigned 16-bit number.
+    def fill_buffer(self, n: int) -> None:
+        """Read input until the buffer contains at least n bytes, including
+        what is already available in a single read.
         """
-        b = self.io.read(2)
-        if len(b) == 0:
-            raise TimeoutError()
-        elif len(b) == 1:
-            b1 = self.io.read(1)
-            if len(b1) == 0:
+        while len(self.buffer) < n:
+            if (self.selector is not None
+                    and len(self.selector.select(self.select_timeout)) == 0):
                 raise TimeoutError()
-            return b[0] + 256 * b1[0]
-        else:
-            return b[0] + 256 * b[1]
+            b = self.io.read(max(n - len(self.buffer),
+                                 getattr(self.io, "in_waiting", 0)))
+            if len(b) == 0:
+                raise TimeoutError()
+            self.buffer += b
 
     def read_message(self) -> Message:
         """Read a complete message.
         """
         try:
-            payload_len = self.read_uint16()
-            source_node = self.read_uint16()
-            id = self.read_uint16()
-            payload = self.io.read(payload_len)
+            self.fill_buffer(_header.size)
+            payload_len, source_node, id = _header.unpack_from(self.buffer)
+            msg_len = _header.size + payload_len
+            self.fill_buffer(msg_len)
+            with memoryview(self.buffer) as view:
+                payload = bytes(view[_header.size:msg_len])
+            del self.buffer[:msg_len]
             msg = Message(id, source_node, payload)
             return msg
         except Exception as error:
             self.comm_error = error
             raise error
 
+    def has_buffered_message(self) -> bool:
+        """Check if a complete message has already been read in the buffer.
+        """
+        return (len(self.buffer) >= _header.size
+                and len(self.buffer) >= _header.size + _header.unpack_from(self.buffer)[0])
+
+    def create_tasks(self, coros) -> None:
+        """Create tasks for message handlers (called in the loop thread).
+        """
+        for coro in coros:
+            self.loop.create_task(coro)
+
     def run(self) -> None:
         """Input thread code.
         """
         while self.running:
             try:
-                msg = self.read_message()
-                msg.decode()
+                msgs = [self.read_message()]
+                # messages already received are handed over together
+                while self.has_buffered_message():
+                    msgs.append(self.read_message())
+                for msg in msgs:
+                    msg.decode_inbound()
                 if self.loop and self.handle_msg:
-                    self.loop.create_task(self.handle_msg(msg))
+                    # create_task isn't thread-safe: schedule it in the loop
+                    self.loop.call_soon_threadsafe(self.create_tasks,
+                                                   [self.handle_msg(msg) for msg in msgs])
             except TimeoutError:
                 pass
+        if self.selector is not None:
+            self.selector.close()
         if self.on_terminated:
             self.on_terminated()
 
 
+class OutputThread(threading.Thread):
+    """Thread which writes messages asynchronously, so that sending doesn't
+    block the caller, unless max_pending writes are already pending. A write
+    error is kept in comm_error until raise_error() is called and passed to
+    on_error, called in loop if there is one (like messages of InputThread).
+    """
+
+    def __init__(self, io, output_lock, loop=None, on_error=None,
+                 max_pending=256, timeout=3):
+        threading.Thread.__init__(self)
+        self.io = io
+        self.output_lock = output_lock
+        self.loop = loop
+        self.on_error = on_error
+        self.max_pending = max_pending
+        self.timeout = timeout  # max wait for room in pending before an error
+        self.pending = collections.deque()  # bytes waiting to be written
+        self.condition = threading.Condition()  # notified when state changes
+        self.writing = False  # True while data taken from pending is written
+        self.terminating = False  # True once terminate() has been called
+        self.terminated = False  # True once the thread has stopped
+        self.comm_error = None
+
+    def write(self, data: bytes) -> None:
+        """Queue data to be written. Data written after terminate() has been
+        called is dropped. If max_pending writes are already pending, a
+        GET_VARIABLES request identical to a pending one is dropped; anything
+        else waits until there is room, and raises a communication error if
+        no data has been written for timeout seconds (link dead).
+        """
+        with self.condition:
+            if self.terminating:
+                return
+            if len(self.pending) >= self.max_pending:
+                if (len(data) >= _header.size
+                        and _header.unpack_from(data)[2] == Message.ID_GET_VARIABLES
+                        and data in self.pending):
+                    # stale request: the pending one will fetch the values
+                    return
+                if not self.condition.wait_for(
+                        lambda: self.terminating or len(self.pending) < self.max_pending,
+                        timeout=self.timeout):
+                    error = OSError(f"output stalled ({len(self.pending)} writes pending)")
+                    self.report_error(error)
+                    raise error
+                if self.terminating:
+                    return
+            self.pending.append(data)
+            self.condition.notify_all()
+
+    def terminate(self) -> None:
+        """Terminate thread once pending data has been written.
+        """
+        with self.condition:
+            self.terminating = True
+            self.condition.notify_all()
+
+    def drain(self) -> None:
+        """Wait until pending data has been written, or until the thread has
+        stopped.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.terminated
+                                    or (len(self.pending) == 0 and not self.writing))
+
+    def report_error(self, error: Exception) -> None:
+        """Remember a communication error until raise_error() is called and
+        notify it.
+        """
+        with self.condition:
+            self.comm_error = error
+        if self.on_error:
+            if self.loop is None:
+                self.on_error(error)
+            else:
+                try:
+                    # on_error isn't thread-safe: schedule it in the loop
+                    self.loop.call_soon_threadsafe(self.on_error, error)
+                except RuntimeError:
+                    # loop closed
+                    pass
+
+    def raise_error(self) -> None:
+        """Raise the communication error of a previous write, once.
+        """
+        with self.condition:
+            error = self.comm_error
+            self.comm_error = None
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def merge_set_variables(data: List[bytes], max_size: int = 256) -> List[bytes]:
+        """Merge consecutive SET_VARIABLES messages for contiguous variables of
+        the same node into single messages of up to max_size values.
+        """
+        merged = []
+        prev = None  # header of merged[-1] if it's a SET_VARIABLES message
+        for msg in data:
+            header = None
+            if len(msg) >= _set_variables_header.size:
+                header = _set_variables_header.unpack_from(msg)
+                if (header[2] != Message.ID_SET_VARIABLES
+                        or len(msg) != _header.size + header[0]):
+                    # not a single SET_VARIABLES message
+                    header = None
+            if header is not None and prev is not None:
+                payload_len, source, id, target, offset = header
+                prev_len, prev_source, _, prev_target, prev_offset = prev
+                count = (payload_len - 4) // 2
+                prev_count = (prev_len - 4) // 2
+                if ((source, target) == (prev_source, prev_target)
+                        and offset == prev_offset + prev_count
+                        and prev_count + count <= max_size):
+                    payload_len = prev_len + 2 * count
+                    merged[-1] = (_header.pack(payload_len, source, id)
+                                  + merged[-1][_header.size:]
+                                  + msg[_set_variables_header.size:])
+                    prev = (payload_len, source, id, target, prev_offset)
+                    continue
+            merged.append(msg)
+            prev = header
+        return merged
+
+    def run(self) -> None:
+        """Output thread code.
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.terminating
+                                        or len(self.pending) > 0)
+                if len(self.pending) == 0:
+                    # terminating and nothing left to write
+                    break
+                # get all pending data to write it at once
+                data = list(self.pending)
+                self.pending.clear()
+                self.writing = True
+                self.condition.notify_all()
+            try:
+                data = self.merge_set_variables(data)
+                with self.output_lock:
+                    self.io.write(b"".join(data))
+            except Exception as error:
+                self.report_error(error)
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+        with self.condition:
+            self.terminated = True
+            self.condition.notify_all()
+
+
 class RemoteNode:
     """Remote node description and state.
     """
@@ -89,7 +307,7 @@ class RemoteNode:
         self.rf_network_id = None
         self.rf_node_id = None
         self.rf_channel = None
-        self.last_msg_time = 0  # time.time()
+        self.last_msg_time = 0  # time.monotonic()
         self.handshake_done = False
         self.name = None
         self.bytecode_size = None
@@ -102,7 +320,7 @@ class RemoteNode:
         self.named_variables = []  # names
         self.var_offset = {}  # indexed by name
         self.var_size = {}  # indexed by name
-        self.var_data = []
+        self.var_data = array.array("h")  # signed 16-bit values
         self.expected_var_end = 0  # beyond last var requested by ID_GET_VARIABLES
         self.var_received = False  # True if last set_var_data reached expected_var_end
         self.local_events = []  # names
@@ -126,7 +344,7 @@ class RemoteNode:
     def reset_var_data(self) -> None:
         """Reset the variable data to 0.
         """
-        self.var_data = [0 for i in range(self.var_total_size)]
+        self.var_data = array.array("h", [0]) * self.var_total_size
 
     def get_var(self, name: str, index: int = 0) -> int:
         """Get the value of a scalar variable or an item in an array variable.
@@ -139,43 +357,91 @@ class RemoteNode:
         if name not in self.var_offset:
             raise KeyError(name)
         offset = self.var_offset[name]
-        return self.var_data[offset:offset + self.var_size[name]]
+        return self.var_data[offset:offset + self.var_size[name]].tolist()
 
     def set_var(self, name: str, val: int, index: Optional[int] = 0) -> None:
         """Set the value of a scalar variable or an item in an array variable.
         """
-        self.var_data[self.var_offset[name] + index] = val
+        self.var_data[self.var_offset[name] + index] = _int16(val)
 
-    def set_var_array(self, name: str, val: List[int]) -> None:
+    def set_var_array(self, name: str, val: Sequence[int]) -> None:
         """Set the value of an array variable.
         """
         offset = self.var_offset[name]
-        self.var_data[offset:offset + len(val)] = val
+        self.var_data[offset:offset + len(val)] = array.array("h", [_int16(v) for v in val])
 
     def set_var_data(self, offset: int, data: List[int]) -> int:
-        """Set values in the variable data array.
+        """Set values in the variable data array from unsigned 16-bit numbers
+        as received in messages.
         """
-        self.var_data[offset:offset + len(data)] = data
+        self.var_data[offset:offset + len(data)] = array.array("h", array.array("H", data).tobytes())
         self.var_received = offset + len(data) >= self.expected_var_end
 
+    def set_var_data_bytes(self, offset: int, data: bytes) -> None:
+        """Set values in the variable data array from 16-bit little-endian
+        words, such as the payload of VARIABLES messages after the offset.
+        """
+        words = array.array("h")
+        # ignore a trailing odd byte of a malformed message
+        words.frombytes(data[:len(data) & ~1])
+        if sys.byteorder == "big":
+            words.byteswap()
+        self.var_data[offset:offset + len(words)] = words
+        self.var_received = offset + len(words) >= self.expected_var_end
+
     def data_span_for_variables(self, variables: Set[str]) -> Tuple[int, int]:
         """Find the offset and length of the span covering the set of variables.
         """
-        offset = None
-        length = 0
-        for name in variables:
-            if name not in self.var_offset:
-                raise KeyError(name)
-            if offset is None:
-                offset = self.var_offset[name]
-                length = self.var_size[name]
-            elif self.var_offset[name] < offset:
-                length += offset - self.var_offset[name]
-                offset = self.var_offset[name]
-                length = max(length, self.var_size[name])
+        if len(variables) == 0:
+            return None, 0
+        offset = min(self.var_offset[name] for name in variables)
+        end = max(self.var_offset[name] + self.var_size[name] for name in variables)
+        return offset, end - offset
+
+
+class NodeProxy:
+    """Access to the variables of a node by name, as returned by
+    Connection.__getitem__.
+    """
+
+    __slots__ = ("connection", "node_id")
+
+    def __init__(self, connection: "Connection", node_id: int):
+        self.connection = connection
+        self.node_id = node_id
+
+    def __getitem__(self, name):
+        try:
+            val = self.connection.get_var_array(self.node_id, name)
+            return val if len(val) != 1 else val[0]
+        except KeyError:
+            raise KeyError(name)
+
+    def get(self, name, index=0):
+        """Get the value of a scalar variable or of an item in an
+        array variable, without copying the whole array.
+        """
+        try:
+            return self.connection.get_var(self.node_id, name, index)
+        except KeyError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, val):
+        try:
+            if _is_array(val):
+                self.connection.set_var_array(self.node_id, name, val)
             else:
-                length = max(length, self.var_offset[name] + self.var_size[name] - offset)
-        return offset, length
+                self.connection.set_var(self.node_id, name, val)
+        except KeyError:
+            raise KeyError(name)
+
+    def update(self, values):
+        """Set several variables (dict name: value), sent together.
+        """
+        try:
+            self.connection.set_vars(self.node_id, values)
+        except KeyError as error:
+            raise KeyError(error.args[0])
 
 
 class Connection:
@@ -189,6 +455,7 @@ class Connection:
                  io,
                  host_node_id=1,
                  refreshing_rate=None, refreshing_coverage=None, discover_rate=None,
+                 refreshing_rate_max=None,
                  debug=False,
                  loop=None):
         self.has_own_loop = loop is None
@@ -203,7 +470,9 @@ class Connection:
         self.host_node_id = host_node_id
         self.auto_handshake = False
         self.remote_node_set = set()  # set of id of nodes with handshake done
+        self.handshake_condition = threading.Condition()  # notified upon handshake
         self.remote_nodes = {}  # key: node_id
+        self.uuid_node_ids = {}  # key: device uuid, value: node_id
 
         self.input_lock = threading.Lock()
         self.input_thread = InputThread(self.io,
@@ -212,14 +481,32 @@ class Connection:
         self.input_thread.start()
 
         self.output_lock = threading.Lock()
+
+        def on_output_error(error):
+            self.comm_error = error
+            if self.on_comm_error:
+                self.on_comm_error("write: " + str(error))
+        self.output_thread = OutputThread(self.io,
+                                          self.output_lock,
+                                          loop=self.loop,
+                                          on_error=on_output_error,
+                                          timeout=self.timeout)
+        self.output_thread.start()
+        self.command_messages = {}  # key: (msg_id, arg...)
+        self.node_proxies = {}  # key: node_id, value: NodeProxy
+        # attribute msgs: list of messages sent by batch_sends() in the
+        # current thread, or None (unset) outside of batch_sends()
+        self.batch = threading.local()
+
         self.shutting_down = False
         self.tasks = set()
         self.refreshing_timeout = None
+        self.refreshing_timeout_max = None  # or max timeout while variables don't change
         self.refreshing_data_coverage = None    # or set of variables to fetch
         self.refreshing_data_span = None   # or (offset, length) (based on refreshing_data_coverage)
         self.refreshing_triggers = []   # threading.Event
         if refreshing_rate is not None:
-            self.set_refreshing_rate(refreshing_rate)
+            self.set_refreshing_rate(refreshing_rate, refreshing_rate_max)
         if refreshing_coverage is not None:
             self.set_refreshing_coverage(refreshing_coverage)
 
@@ -239,7 +526,7 @@ class Connection:
         # async fun(node_id, event_id, event_args)
         self.on_user_event = None
 
-        # callback for communication error notification
+        # callback for communication error notification, called in the loop
         # fun(error)
         self.on_comm_error = None
 
@@ -270,10 +557,40 @@ class Connection:
         self.shutting_down = True
 
         def on_terminated():
+            self.output_thread.join()
             self.close()
 
+        self.output_thread.terminate()
         self.input_thread.terminate(on_terminated)
 
+    async def drain_writes(self) -> None:
+        """Wait until the messages sent so far have been transmitted.
+        """
+        flush = getattr(self.io, "flush", None)
+
+        def drain_output():
+            self.output_thread.drain()
+            if flush is not None and not self.io.closed:
+                with self.output_lock:
+                    flush()
+        await self.loop.run_in_executor(None, drain_output)
+
+    async def shutdown_tasks(self, timeout: Optional[float] = 1) -> None:
+        """Wait until pending output has been transmitted, shutdown, cancel the
+        tasks and wait until they have finished.
+        """
+        if not self.shutting_down:
+            try:
+                await asyncio.wait_for(self.drain_writes(), timeout=timeout)
+            except (asyncio.TimeoutError, OSError):
+                pass
+        self.shutdown()
+        tasks = [task for task in self.tasks if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if len(tasks) > 0:
+            await asyncio.wait(tasks, timeout=timeout)
+
     def run_tasks(self) -> None:
         """Run asyncio loop until all the tasks have finished.
         """
@@ -297,28 +614,16 @@ class Connection:
         """Get the list of serial ports for the current platform.
         """
         import sys
-        import os
+        import glob
         if sys.platform == "linux":
-            devices = [
-                "/dev/" + filename
-                for filename in os.listdir("/dev")
-                if filename.startswith("ttyACM")
-            ]
+            devices = glob.glob("/dev/ttyACM*")
         elif sys.platform == "darwin":
-            devices = [
-                "/dev/" + filename
-                for filename in os.listdir("/dev")
-                if filename.startswith("cu.usb")
-            ]
+            devices = glob.glob("/dev/cu.usb*")
         elif sys.platform == "win32":
             import subprocess
             import re
             mode_output = subprocess.check_output("mode", shell=True).decode()
-            devices = [
-                re.search(r"(COM\d+):", line).groups()[0]
-                for line in mode_output.split("\n")
-                if re.search(r"(COM\d+):", line)
-            ]
+            devices = re.findall(r"(COM\d+):", mode_output)
         else:
             raise Connection.ThymioConnectionError("Unsupported platform")
         return devices
@@ -338,13 +643,23 @@ class Connection:
             return devices[0]
 
     @staticmethod
-    def serial(port: Optional[str] = None, **kwargs) -> "Connection":
+    def serial(port: Optional[str] = None, low_latency: bool = False, **kwargs) -> "Connection":
         """Create Thymio object with a serial connection.
+        With low_latency=True, the serial driver is switched to low-latency
+        mode where supported (Linux), which reduces the round-trip time of
+        messages.
         """
         import serial  # pip3 install pyserial
         if port is None:
             port = Connection.serial_default_port()
-        th = Connection(serial.Serial(port, timeout=1), **kwargs)
+        s = serial.Serial(port, timeout=1)
+        if low_latency:
+            try:
+                s.set_low_latency_mode(True)
+            except (AttributeError, NotImplementedError, ValueError):
+                # not supported by the platform or the driver
+                pass
+        th = Connection(s, **kwargs)
         return th
 
     @staticmethod
@@ -358,14 +673,31 @@ class Connection:
 
             def __init__(self, host, port):
                 self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                # send small messages immediately instead of coalescing them
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 self.socket.connect((host, port))
 
             def read(self, n):
-                return self.socket.recv(n)
+                # recv can return less than requested, e.g. when a large
+                # message spans multiple TCP segments
+                b = self.socket.recv(n)
+                while 0 < len(b) < n:
+                    b1 = self.socket.recv(n - len(b))
+                    if len(b1) == 0:
+                        break
+                    b += b1
+                return b
 
             def write(self, b):
                 self.socket.sendall(b)
 
+            def fileno(self):
+                return self.socket.fileno()
+
+            def close(self):
+                self.socket.close()
+                super().close()
+
         s = TCPClientIO(host, port)
         th = Connection(s, **kwargs)
         return th
@@ -378,12 +710,23 @@ class Connection:
 
         class NullIO(io.RawIOBase):
 
+            def __init__(self):
+                super().__init__()
+                self.closed_event = threading.Event()
+
             def read(self, n):
-                return None
+                # no input: wait, so that the input thread doesn't spin, and
+                # return nothing to let it check whether it should terminate
+                self.closed_event.wait(1)
+                return b""
 
             def write(self, b):
                 pass
 
+            def close(self):
+                self.closed_event.set()
+                super().close()
+
         return Connection(NullIO(), host_node_id)
 
     def handshake(self) -> None:
@@ -395,11 +738,9 @@ class Connection:
         """
         if len(self.remote_node_set) < n and not self.auto_handshake:
             self.handshake()
-        count = timeout // 0.1
-        while len(self.remote_node_set) < n:
-            time.sleep(0.1)
-            count -= 1
-            if count < 0:
+        with self.handshake_condition:
+            if not self.handshake_condition.wait_for(lambda: len(self.remote_node_set) >= n,
+                                                     timeout):
                 raise TimeoutError()
 
     def one_remote_node_id(self) -> int:
@@ -407,10 +748,13 @@ class Connection:
         """
         return next(iter(self.remote_node_set))
 
-    def set_refreshing_rate(self, rate: float) -> None:
-        """Change the auto-refresh rate to update variables.
+    def set_refreshing_rate(self, rate: float, max_rate: Optional[float] = None) -> None:
+        """Change the auto-refresh rate to update variables. If max_rate is
+        specified, the time between refreshes is doubled up to max_rate
+        while the variables don't change, and reset to rate when they do.
         """
         self.refreshing_timeout = rate
+        self.refreshing_timeout_max = max_rate
         if rate is not None:
             # refresh now
             for event in self.refreshing_triggers:
@@ -429,7 +773,20 @@ class Connection:
         if self.debug:
             print("<", msg)
         source_node = msg.source_node
-        if msg.id == Message.ID_NODE_PRESENT:
+        # most frequent messages first
+        if msg.id == Message.ID_VARIABLES:
+            with self.input_lock:
+                remote_node = self.remote_nodes[source_node]
+                # words copied from the payload, without conversion to int
+                with memoryview(msg.payload) as view:
+                    remote_node.set_var_data_bytes(msg.var_offset, view[2:])
+            if self.on_variables_received and remote_node.var_received:
+                await self.on_variables_received(source_node)
+        elif msg.id < Message.ID_FIRST_ASEBA_ID:
+            # user event sent by emit
+            if self.on_user_event:
+                await self.on_user_event(source_node, msg.id, msg.user_event_arg)
+        elif msg.id == Message.ID_NODE_PRESENT:
             will_do_handshake = False
             with self.input_lock:
                 if source_node not in self.remote_nodes:
@@ -450,7 +807,9 @@ class Connection:
                         change = True
                 elif msg.device_info == Message.DEVICE_INFO_UUID:
                     if remote_node.device_uuid != msg.device_uuid:
+                        self.uuid_node_ids.pop(remote_node.device_uuid, None)
                         remote_node.device_uuid = msg.device_uuid
+                        self.uuid_node_ids[msg.device_uuid] = source_node
                         change = True
                 elif msg.device_info == Message.DEVICE_INFO_THYMIO2_RF_SETTINGS:
                     if (remote_node.rf_network_id != msg.network_id
@@ -462,13 +821,14 @@ class Connection:
                         change = True
         elif msg.id == Message.ID_DESCRIPTION:
             with self.input_lock:
-                self.remote_nodes[source_node].name = msg.node_name
-                self.remote_nodes[source_node].bytecode_size = msg.bytecode_size
-                self.remote_nodes[source_node].stack_size = msg.stack_size
-                self.remote_nodes[source_node].max_var_size = msg.max_var_size
-                self.remote_nodes[source_node].num_named_var = msg.num_named_var
-                self.remote_nodes[source_node].num_local_events = msg.num_local_events
-                self.remote_nodes[source_node].num_native_fun = msg.num_native_fun
+                remote_node = self.remote_nodes[source_node]
+                remote_node.name = msg.node_name
+                remote_node.bytecode_size = msg.bytecode_size
+                remote_node.stack_size = msg.stack_size
+                remote_node.max_var_size = msg.max_var_size
+                remote_node.num_named_var = msg.num_named_var
+                remote_node.num_local_events = msg.num_local_events
+                remote_node.num_native_fun = msg.num_native_fun
         elif msg.id == Message.ID_NAMED_VARIABLE_DESCRIPTION:
             with self.input_lock:
                 remote_node = self.remote_nodes[source_node]
@@ -478,12 +838,25 @@ class Connection:
                     remote_node.reset_var_data()
 
                     async def do_refresh():
+                        timeout = None
+                        var_data_prev = None
                         while not self.shutting_down:
                             try:
                                 if self.refreshing_timeout is None:
                                     await asyncio.sleep(0.1)
                                 else:
-                                    await asyncio.sleep(self.refreshing_timeout)
+                                    if self.refreshing_timeout_max is None:
+                                        timeout = self.refreshing_timeout
+                                    else:
+                                        # adapt timeout to the changes of variables
+                                        with self.input_lock:
+                                            var_data = remote_node.var_data[:]
+                                        if timeout is None or var_data != var_data_prev:
+                                            timeout = self.refreshing_timeout
+                                        else:
+                                            timeout = min(2 * timeout, self.refreshing_timeout_max)
+                                        var_data_prev = var_data
+                                    await asyncio.sleep(timeout)
                                     if self.refreshing_data_coverage is None:
                                         self.get_variables(source_node)
                                     else:
@@ -495,28 +868,24 @@ class Connection:
                                 if self.shutting_down:
                                     break
                                 # assume disconnection upon timeout
-                                current_time = time.time()
-                                terminating_nodes = set()
-                                for node_id in self.remote_node_set:
-                                    with self.input_lock:
-                                        terminated_node = self.remote_nodes[node_id]
-                                        if current_time - terminated_node.last_msg_time > self.timeout:
-                                            terminating_nodes.add(node_id)
+                                current_time = time.monotonic()
+                                with self.input_lock:
+                                    terminating_nodes = [
+                                        node_id
+                                        for node_id in self.remote_node_set
+                                        if current_time - self.remote_nodes[node_id].last_msg_time > self.timeout
+                                    ]
                                 for node_id in terminating_nodes:
                                     self.remote_node_set.remove(node_id)
                                     if self.on_connection_changed:
                                         await self.on_connection_changed(node_id, False)
-                                    del self.remote_nodes[node_id]
+                                    with self.input_lock:
+                                        self.uuid_node_ids.pop(self.remote_nodes[node_id].device_uuid, None)
+                                        del self.remote_nodes[node_id]
                             except asyncio.CancelledError:
                                 break
 
                     self.tasks.add(self.loop.create_task(do_refresh()))
-        elif msg.id == Message.ID_VARIABLES:
-            with self.input_lock:
-                remote_node = self.remote_nodes[source_node]
-                remote_node.set_var_data(msg.var_offset, msg.var_data)
-            if self.on_variables_received and remote_node.var_received:
-                await self.on_variables_received(source_node)
         elif msg.id == Message.ID_NATIVE_FUNCTION_DESCRIPTION:
             with self.input_lock:
                 remote_node = self.remote_nodes[source_node]
@@ -526,7 +895,9 @@ class Connection:
                 # all messages sent as reply to GET_NODE_DESCRIPTION received
                 self.remote_nodes[source_node].handshake_done = True
                 if source_node not in self.remote_node_set:
-                    self.remote_node_set.add(source_node)
+                    with self.handshake_condition:
+                        self.remote_node_set.add(source_node)
+                        self.handshake_condition.notify_all()
                     if self.on_connection_changed:
                         await self.on_connection_changed(source_node, True)
         elif msg.id == Message.ID_LOCAL_EVENT_DESCRIPTION:
@@ -536,54 +907,87 @@ class Connection:
         elif msg.id == Message.ID_EXECUTION_STATE_CHANGED:
             if self.on_execution_state_changed:
                 await self.on_execution_state_changed(source_node, msg.pc, msg.flags)
-        elif msg.id < Message.ID_FIRST_ASEBA_ID:
-            # user event sent by emit
-            if self.on_user_event:
-                await self.on_user_event(source_node, msg.id, msg.user_event_arg)
-        with self.input_lock:
-            self.remote_nodes[source_node].last_msg_time = time.time()
+        # no lock: assigning an attribute is atomic
+        self.remote_nodes[source_node].last_msg_time = time.monotonic()
 
     def uuid_to_node_id(self, uuid: str) -> int:
         """Get node id from device uuid.
         """
-        for node in self.remote_nodes.values():
-            if node.device_uuid == uuid:
-                return node.node_id
+        return self.uuid_node_ids.get(uuid)
 
     def send(self, msg: Message) -> None:
-        """Send a message.
+        """Send a message (queued to be written by the output thread), or
+        drop it if the connection is shutting down. A write error is
+        notified to on_comm_error and raised by the next send.
         """
-        with self.output_lock:
-            if self.debug:
+        if self.shutting_down:
+            return
+        batched_msgs = getattr(self.batch, "msgs", None)
+        if batched_msgs is not None:
+            batched_msgs.append(msg)
+            return
+        if self.debug:
+            print(">", msg)
+        self.output_thread.raise_error()
+        self.output_thread.write(msg.serialize())
+
+    def send_many(self, msgs: List[Message]) -> None:
+        """Send messages together, in a single write (dropped if the
+        connection is shutting down).
+        """
+        if self.shutting_down:
+            return
+        if self.debug:
+            for msg in msgs:
                 print(">", msg)
-            try:
-                self.io.write(msg.serialize())
-            except Exception as error:
-                self.comm_error = error
-                if self.on_comm_error:
-                    self.on_comm_error("write: " + str(error))
-                raise error
+        self.output_thread.raise_error()
+        self.output_thread.write(b"".join([msg.serialize() for msg in msgs]))
+
+    @contextlib.contextmanager
+    def batch_sends(self):
+        """Context manager to send all the messages sent in its block
+        together, in a single write at the end of the block. Only messages
+        sent by the current thread are batched.
+        """
+        if getattr(self.batch, "msgs", None) is not None:
+            # already batching
+            yield
+            return
+        msgs = []
+        self.batch.msgs = msgs
+        try:
+            yield
+        finally:
+            self.batch.msgs = None
+            if len(msgs) > 0:
+                self.send_many(msgs)
+
+    def send_command(self, msg_id: int, arg: int) -> None:
+        """Send a message whose payload is a single 16-bit number (usually the
+        target node id), created once for each id and argument.
+        """
+        key = (msg_id, arg)
+        if key not in self.command_messages:
+            payload = Message.uint16_to_bytes(arg)
+            self.command_messages[key] = Message(msg_id, self.host_node_id, payload)
+        self.send(self.command_messages[key])
 
     def get_target_node_var_total_size(self, target_node_id):
         """Get the total size of variables.
         """
-        with self.input_lock:
-            return self.remote_nodes[target_node_id].var_total_size
+        # no lock: reading an attribute is atomic
+        return self.remote_nodes[target_node_id].var_total_size
 
     def list_nodes(self):
         """Send a LIST_NODES message.
         """
-        payload = Message.uint16array_to_bytes([Message.PROTOCOL_VERSION])
-        msg = Message(Message.ID_LIST_NODES, self.host_node_id, payload)
-        self.send(msg)
+        self.send_command(Message.ID_LIST_NODES, Message.PROTOCOL_VERSION)
 
     def get_node_description(self, target_node_id):
         """Send a GET_NODE_DESCRIPTION message.
         """
-        payload = Message.uint16array_to_bytes([
-            target_node_id,
-            Message.PROTOCOL_VERSION
-        ])
+        payload = Message.uint16_pair_to_bytes(target_node_id,
+                                               Message.PROTOCOL_VERSION)
         msg = Message(Message.ID_GET_NODE_DESCRIPTION, self.host_node_id, payload)
         self.send(msg)
 
@@ -605,22 +1009,25 @@ class Connection:
             if chunk_length is None:
                 chunk_length = (self.get_target_node_var_total_size(target_node_id)
                                 - chunk_offset)
-            payload = Message.uint16array_to_bytes([
-                target_node_id,
-                chunk_offset,
-                chunk_length
-            ])
-            msg = Message(Message.ID_GET_VARIABLES, self.host_node_id, payload)
+            # same message at each refresh: created once
+            key = (Message.ID_GET_VARIABLES, target_node_id, chunk_offset, chunk_length)
+            msg = self.command_messages.get(key)
+            if msg is None:
+                payload = Message.uint16array_to_bytes([
+                    target_node_id,
+                    chunk_offset,
+                    chunk_length
+                ])
+                msg = Message(Message.ID_GET_VARIABLES, self.host_node_id, payload)
+                self.command_messages[key] = msg
             self.remote_nodes[target_node_id].expected_var_end = chunk_offset + chunk_length
             self.send(msg)
 
     def set_variables(self, target_node_id, chunk_offset, chunk):
         """Send a SET_VARIABLES message.
         """
-        payload = Message.uint16array_to_bytes([
-            target_node_id,
-            chunk_offset
-        ] + chunk)
+        payload = (Message.uint16_pair_to_bytes(target_node_id, chunk_offset)
+                   + Message.uint16array_to_bytes(chunk))
         msg = Message(Message.ID_SET_VARIABLES, self.host_node_id, payload)
         self.send(msg)
 
@@ -641,17 +1048,17 @@ class Connection:
     def get_var(self, target_node_id, name, index=0):
         """Get the value of a scalar variable from the local copy.
         """
+        # no lock: var_data is an array whose items and slices are read and
+        # written by single operations which the GIL makes atomic
         node = self.remote_nodes[target_node_id]
-        with self.input_lock:
-            return node.get_var(name, index)
+        return node.get_var(name, index)
 
     def get_var_array(self, target_node_id, name):
         """Get the value of an array variable from the local copy.
         """
         node = self.remote_nodes[target_node_id]
         try:
-            with self.input_lock:
-                return node.get_var_array(name)
+            return node.get_var_array(name)
         except KeyError:
             raise KeyError(name)
 
@@ -671,63 +1078,83 @@ class Connection:
             node.set_var_array(name, val)
         self.set_variables(target_node_id, node.var_offset[name], val)
 
-    def __getitem__(self, key):
-        class Node:
-
-            def __init__(self_node, connection, node_id):
-                self_node.connection = connection
-                self_node.node_id = node_id
-
-            def __getitem__(self_node, name):
-                try:
-                    val = self_node.connection.get_var_array(self_node.node_id, name)
-                    return val if len(val) != 1 else val[0]
-                except KeyError:
-                    raise KeyError(name)
-
-            def __setitem__(self_node, name, val):
-                try:
-                    if isinstance(val, list):
-                        self_node.connection.set_var_array(self_node.node_id, name, val)
-                    else:
-                        self_node.connection.set_var(self_node.node_id, name, val)
-                except KeyError:
-                    raise KeyError(name)
+    def set_vars(self, target_node_id, values):
+        """Set the values of several variables (dict name: value, where value
+        is a scalar or a sequence) in the local copy and send them, with a single
+        SET_VARIABLES message for variables at consecutive addresses.
+        """
+        node = self.remote_nodes[target_node_id]
+        chunks = []  # list of (offset, list of values)
+        with self.input_lock:
+            for name in sorted(values, key=lambda name: node.var_offset[name]):
+                val = values[name]
+                if _is_array(val):
+                    node.set_var_array(name, val)
+                else:
+                    node.set_var(name, val)
+                    val = [val]
+                offset = node.var_offset[name]
+                if len(chunks) > 0 and chunks[-1][0] + len(chunks[-1][1]) == offset:
+                    chunks[-1][1].extend(val)
+                else:
+                    chunks.append((offset, list(val)))
+        with self.batch_sends():
+            for offset, chunk in chunks:
+                self.set_variables(target_node_id, offset, chunk)
 
-        return Node(self, key)
+    def __getitem__(self, key):
+        node = self.node_proxies.get(key)
+        if node is None:
+            node = NodeProxy(self, key)
+            self.node_proxies[key] = node
+        return node
 
     def set_bytecode(self, target_node_id, bytecode, address=0):
         """Set the bytecode by sending one or more SET_BYTECODE messages.
+        The bytecode is a sequence of 16-bit words, such as a list or an
+        array.array("H").
         """
+        if self.shutting_down:
+            return
+        if not (isinstance(bytecode, array.array) and bytecode.typecode == "H"):
+            bytecode = array.array("H", [word & 0xffff for word in bytecode])
+        elif sys.byteorder == "big":
+            bytecode = array.array("H", bytecode)
+        if sys.byteorder == "big":
+            bytecode.byteswap()
+        # chunks are sliced from the little-endian words without copy
+        view = memoryview(bytecode).cast("B")
         size = len(bytecode)
-        i = 0
-        while i < size:
+        if self.debug or getattr(self.batch, "msgs", None) is not None:
+            # Message objects, to be displayed or batched
+            for i in range(0, size, 256):
+                payload = (Message.uint16_pair_to_bytes(target_node_id, address + i)
+                           + view[2 * i:2 * min(i + 256, size)])
+                self.send(Message(Message.ID_SET_BYTECODE, self.host_node_id, payload))
+            return
+
+        # frames packed directly and written at once
+        self.output_thread.raise_error()
+        frames = bytearray()
+        for i in range(0, size, 256):
             size_chunk = min(size - i, 256)
-            payload = Message.uint16array_to_bytes([
-                target_node_id,
-                address + i
-            ] + bytecode[i:i + size_chunk])
-            msg = Message(Message.ID_SET_BYTECODE, self.host_node_id, payload)
-            self.send(msg)
-            i += size_chunk
+            frames += _set_variables_header.pack(4 + 2 * size_chunk,
+                                                 self.host_node_id,
+                                                 Message.ID_SET_BYTECODE,
+                                                 target_node_id,
+                                                 (address + i) & 0xffff)
+            frames += view[2 * i:2 * (i + size_chunk)]
+        self.output_thread.write(bytes(frames))
 
     def reset(self, target_node_id):
         """Reset the Thymio.
         """
-        payload = Message.uint16array_to_bytes([
-            target_node_id,
-        ])
-        msg = Message(Message.ID_RESET, self.host_node_id, payload)
-        self.send(msg)
+        self.send_command(Message.ID_RESET, target_node_id)
 
     def run(self, target_node_id):
         """Run the code on the Thymio.
         """
-        payload = Message.uint16array_to_bytes([
-            target_node_id,
-        ])
-        msg = Message(Message.ID_RUN, self.host_node_id, payload)
-        self.send(msg)
+        self.send_command(Message.ID_RUN, target_node_id)
 
     def get_device_info(self, target_node_id, info=None):
         """Request device info (all available by default).
@@ -740,9 +1167,6 @@ class Connection:
             self.get_device_info(target_node_id,
                                  Message.DEVICE_INFO_UUID)
         else:
-            payload = Message.uint16array_to_bytes([
-                target_node_id,
-                info
-            ])
+            payload = Message.uint16_pair_to_bytes(target_node_id, info)
             msg = Message(Message.ID_GET_DEVICE_INFO, self.host_node_id, payload)
             self.send(msg)
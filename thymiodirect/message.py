@@ -7,8 +7,17 @@
 
 # Messages defined for Aseba communication protocol
 
+import array
+import struct
+import sys
 import uuid
 
+_uint16 = struct.Struct("<H")
+_uint16_pair = struct.Struct("<HH")
+
+# message header: payload length, source node id, message id
+_header = struct.Struct("<HHH")
+
 
 class Message:
     """Aseba message data.
@@ -61,6 +70,11 @@ class Message:
     DEVICE_INFO_NAME = 2
     DEVICE_INFO_THYMIO2_RF_SETTINGS = 3
 
+    # slots for the properties of all messages and of VARIABLES messages,
+    # by far the most frequent ones; properties decoded from other messages
+    # are stored in __dict__, created only when needed
+    __slots__ = ("id", "source_node", "payload", "var_offset", "__dict__")
+
     def __init__(self, id, source_node, payload):
         self.id = id
         self.source_node = source_node
@@ -74,204 +88,282 @@ class Message:
     def get_uint16(self, offset):
         """Get an unsigned 16-bit integer in the payload.
         """
-        return self.payload[offset] + 256 * self.payload[offset + 1], offset + 2
+        return _uint16.unpack_from(self.payload, offset)[0], offset + 2
+
+    def get_uint16_array(self, offset, count=None):
+        """Get an array of unsigned 16-bit integers in the payload (by default
+        up to its end), decoded at once.
+        """
+        if count is None:
+            count = (len(self.payload) - offset) // 2
+        a = array.array("H")
+        with memoryview(self.payload) as view:
+            a.frombytes(view[offset:offset + 2 * count])
+        if sys.byteorder == "big":
+            a.byteswap()
+        return a.tolist(), offset + 2 * count
 
     def get_string(self, offset):
         """Get a string in the payload.
         """
-        len = self.payload[offset]
-        str = self.payload[offset + 1:offset + 1 + len]
-        return str.decode('utf-8'), offset + 1 + len
+        length = self.payload[offset]
+        data = self.payload[offset + 1:offset + 1 + length]
+        return data.decode('utf-8'), offset + 1 + length
 
     @staticmethod
     def uint16_to_bytes(word):
         """Convert an unsigned 16-bit integer to bytes.
         """
-        return bytes([word & 0xff, (word & 0xff00) // 256])
+        return _uint16.pack(word & 0xffff)
+
+    @staticmethod
+    def uint16_pair_to_bytes(word1, word2):
+        """Convert two unsigned 16-bit integers to bytes.
+        """
+        return _uint16_pair.pack(word1 & 0xffff, word2 & 0xffff)
 
     @staticmethod
     def uint16array_to_bytes(a):
         """Convert an array of unsigned 16-bit integer to bytes.
         """
-        bytes = b""
-        for word in a:
-            bytes += Message.uint16_to_bytes(word)
-        return bytes
+        if isinstance(a, array.array) and a.typecode in ("h", "H"):
+            # already 16-bit words: copy them as is
+            if sys.byteorder == "big":
+                a = array.array(a.typecode, a)
+                a.byteswap()
+            return a.tobytes()
+        return struct.pack(f"<{len(a)}H", *[word & 0xffff for word in a])
 
     def decode(self):
         """Decode message properties from its payload.
         """
-        if self.id == Message.ID_DESCRIPTION:
-            self.node_name, offset = self.get_string(0)
-            self.protocol_version, offset = self.get_uint16(offset)
-            self.bytecode_size, offset = self.get_uint16(offset)
-            self.stack_size, offset = self.get_uint16(offset)
-            self.max_var_size, offset = self.get_uint16(offset)
-            self.num_named_var, offset = self.get_uint16(offset)
-            self.num_local_events, offset = self.get_uint16(offset)
-            self.num_native_fun, offset = self.get_uint16(offset)
-        elif self.id == Message.ID_NAMED_VARIABLE_DESCRIPTION:
-            self.var_size, offset = self.get_uint16(0)
-            self.var_name, offset = self.get_string(offset)
-        elif self.id == Message.ID_LOCAL_EVENT_DESCRIPTION:
-            self.event_name, offset = self.get_string(0)
-            self.description, offset = self.get_string(offset)
-        elif self.id == Message.ID_NATIVE_FUNCTION_DESCRIPTION:
-            self.fun_name, offset = self.get_string(0)
-            self.description, offset = self.get_string(offset)
-            num_params, offset = self.get_uint16(offset)
-            self.param_names = []
-            self.param_sizes = []
-            for i in range(num_params):
-                size, offset = self.get_uint16(offset)
-                name, offset = self.get_string(offset)
-                self.param_names.append(name)
-                self.param_sizes.append(size)
-        elif self.id == Message.ID_VARIABLES:
-            self.var_offset, offset = self.get_uint16(0)
-            self.var_data = []
-            for i in range(len(self.payload) // 2 - 1):
-                word, offset = self.get_uint16(offset)
-                self.var_data.append(word)
-        elif self.id == Message.ID_EXECUTION_STATE_CHANGED:
-            self.pc, offset = self.get_uint16(0)
-            self.flags, offset = self.get_uint16(offset)
-            self.event_active = (self.flags & 1) != 0
-            self.step_by_step = (self.flags & 2) != 0
-            self.event_running = (self.flags & 4) != 0
-        elif self.id == Message.ID_NODE_PRESENT:
-            self.version, offset = self.get_uint16(0)
-        elif self.id == Message.ID_DEVICE_INFO:
-            self.device_info, offset = self.get_uint8(0)
-            if self.device_info == Message.DEVICE_INFO_NAME:
-                self.device_name, offset = self.get_string(offset)
-            elif self.device_info == Message.DEVICE_INFO_UUID:
-                data_len, offset = self.get_uint8(offset)
-                data = self.payload[offset:offset + data_len]
-                self.device_uuid = str(uuid.UUID(bytes=data))
-            elif self.device_info == Message.DEVICE_INFO_THYMIO2_RF_SETTINGS:
-                data_len, offset = self.get_uint8(offset)
-                if data_len == 6:
-                    self.network_id, offset = self.get_uint16(offset)
-                    self.node_id, offset = self.get_uint16(offset)
-                    self.channel, offset = self.get_uint16(offset)
-        elif self.id == Message.ID_SET_BYTECODE:
-            self.target_node_id, offset = self.get_uint16(0)
-            self.bc_offset, offset = self.get_uint16(offset)
-            val = []
-            for i in range(4, len(self.payload), 2):
-                instr, offset = self.get_uint16(offset)
-                val.append(instr)
-            self.bc = val
-        elif (self.id == Message.ID_BREAKPOINT_CLEAR_ALL
-              or self.id == Message.ID_RESET
-              or self.id == Message.ID_RUN
-              or self.id == Message.ID_PAUSE
-              or self.id == Message.ID_STEP
-              or self.id == Message.ID_STOP
-              or self.id == Message.ID_GET_EXECUTION_STATE):
-            self.target_node_id, offset = self.get_uint16(0)
-        elif (self.id == Message.ID_BREAKPOINT_SET
-              or self.id == Message.ID_BREAKPOINT_CLEAR):
-            self.target_node_id, offset = self.get_uint16(0)
-            self.pc, offset = self.get_uint16(offset)
-        elif self.id == Message.ID_GET_VARIABLES:
-            self.target_node_id, offset = self.get_uint16(0)
-            self.var_offset, offset = self.get_uint16(offset)
-            self.var_count, offset = self.get_uint16(offset)
-        elif self.id == Message.ID_SET_VARIABLES:
-            self.target_node_id, offset = self.get_uint16(0)
-            self.var_offset, offset = self.get_uint16(offset)
-            val = []
-            for i in range(4, len(self.payload), 2):
-                v, offset = self.get_uint16(offset)
-                val.append(v)
-            self.var_val = val
-        elif self.id == Message.ID_LIST_NODES:
-            self.version, offset = self.get_uint16(0)
-        elif self.id == Message.ID_GET_NODE_DESCRIPTION_FRAGMENT:
-            self.version, offset = self.get_uint16(0)
-            self.fragment, offset = self.get_uint16(offset)
+        decoder = _decoders.get(self.id)
+        if decoder is not None:
+            decoder(self)
+        elif self.id < Message.ID_FIRST_ASEBA_ID:
+            self.user_event_arg, offset = self.get_uint16_array(0)
+
+    def decode_inbound(self):
+        """Decode message properties from its payload, only for messages
+        the host may handle (descriptions, variables, events etc.); commands
+        sent by other hosts to nodes, such as set_variables, are left
+        undecoded.
+        """
+        decoder = _inbound_decoders.get(self.id)
+        if decoder is not None:
+            decoder(self)
         elif self.id < Message.ID_FIRST_ASEBA_ID:
-            val = []
-            offset = 0
-            for i in range(0, len(self.payload), 2):
-                v, offset = self.get_uint16(offset)
-                val.append(v)
-            self.user_event_arg = val
+            self.user_event_arg, offset = self.get_uint16_array(0)
+
+    def decode_description(self):
+        self.node_name, offset = self.get_string(0)
+        self.protocol_version, offset = self.get_uint16(offset)
+        self.bytecode_size, offset = self.get_uint16(offset)
+        self.stack_size, offset = self.get_uint16(offset)
+        self.max_var_size, offset = self.get_uint16(offset)
+        self.num_named_var, offset = self.get_uint16(offset)
+        self.num_local_events, offset = self.get_uint16(offset)
+        self.num_native_fun, offset = self.get_uint16(offset)
+
+    def decode_named_variable_description(self):
+        self.var_size, offset = self.get_uint16(0)
+        self.var_name, offset = self.get_string(offset)
+
+    def decode_local_event_description(self):
+        self.event_name, offset = self.get_string(0)
+        self.description, offset = self.get_string(offset)
+
+    def decode_native_function_description(self):
+        self.fun_name, offset = self.get_string(0)
+        self.description, offset = self.get_string(offset)
+        num_params, offset = self.get_uint16(offset)
+        self.param_names = [""] * num_params
+        self.param_sizes = [0] * num_params
+        for i in range(num_params):
+            self.param_sizes[i], offset = self.get_uint16(offset)
+            self.param_names[i], offset = self.get_string(offset)
+
+    def decode_variables(self):
+        # var_data is decoded only if requested (see property var_data)
+        self.var_offset, offset = self.get_uint16(0)
+
+    @property
+    def var_data(self):
+        """Values of a VARIABLES message, as unsigned 16-bit numbers.
+        """
+        if self.id != Message.ID_VARIABLES:
+            raise AttributeError("var_data")
+        return self.get_uint16_array(2)[0]
+
+    def decode_execution_state_changed(self):
+        self.pc, offset = self.get_uint16(0)
+        self.flags, offset = self.get_uint16(offset)
+        # event_active, step_by_step and event_running are derived from
+        # flags only if requested (see properties)
+
+    @property
+    def event_active(self):
+        """Event active flag of an EXECUTION_STATE_CHANGED message.
+        """
+        return (self.flags & 1) != 0
+
+    @property
+    def step_by_step(self):
+        """Step-by-step flag of an EXECUTION_STATE_CHANGED message.
+        """
+        return (self.flags & 2) != 0
+
+    @property
+    def event_running(self):
+        """Event running flag of an EXECUTION_STATE_CHANGED message.
+        """
+        return (self.flags & 4) != 0
+
+    def decode_version(self):
+        self.version, offset = self.get_uint16(0)
+
+    def decode_device_info(self):
+        self.device_info, offset = self.get_uint8(0)
+        if self.device_info == Message.DEVICE_INFO_NAME:
+            self.device_name, offset = self.get_string(offset)
+        elif self.device_info == Message.DEVICE_INFO_UUID:
+            data_len, offset = self.get_uint8(offset)
+            data = self.payload[offset:offset + data_len]
+            self.device_uuid = str(uuid.UUID(bytes=data))
+        elif self.device_info == Message.DEVICE_INFO_THYMIO2_RF_SETTINGS:
+            data_len, offset = self.get_uint8(offset)
+            if data_len == 6:
+                self.network_id, offset = self.get_uint16(offset)
+                self.node_id, offset = self.get_uint16(offset)
+                self.channel, offset = self.get_uint16(offset)
+
+    def decode_set_bytecode(self):
+        self.target_node_id, offset = self.get_uint16(0)
+        self.bc_offset, offset = self.get_uint16(offset)
+        self.bc, offset = self.get_uint16_array(offset)
+
+    def decode_target_node(self):
+        self.target_node_id, offset = self.get_uint16(0)
+
+    def decode_breakpoint(self):
+        self.target_node_id, offset = self.get_uint16(0)
+        self.pc, offset = self.get_uint16(offset)
+
+    def decode_get_variables(self):
+        self.target_node_id, offset = self.get_uint16(0)
+        self.var_offset, offset = self.get_uint16(offset)
+        self.var_count, offset = self.get_uint16(offset)
+
+    def decode_set_variables(self):
+        self.target_node_id, offset = self.get_uint16(0)
+        self.var_offset, offset = self.get_uint16(offset)
+        self.var_val, offset = self.get_uint16_array(offset)
+
+    def decode_get_node_description_fragment(self):
+        self.version, offset = self.get_uint16(0)
+        self.fragment, offset = self.get_uint16(offset)
 
     def serialize(self):
         """Serialize message to bytes.
         """
-        return (self.uint16_to_bytes(len(self.payload))
-                + self.uint16_to_bytes(self.source_node)
-                + self.uint16_to_bytes(self.id)
-                + self.payload)
+        return _header.pack(len(self.payload), self.source_node, self.id) + self.payload
 
     @staticmethod
     def id_to_str(id):
         """Convert message id to its name string.
         """
-        try:
-            return {
-                Message.ID_DESCRIPTION: "DESCRIPTION",
-                Message.ID_NAMED_VARIABLE_DESCRIPTION: "ID_NAMED_VARIABLE_DESCRIPTION",
-                Message.ID_LOCAL_EVENT_DESCRIPTION: "ID_LOCAL_EVENT_DESCRIPTION",
-                Message.ID_NATIVE_FUNCTION_DESCRIPTION: "ID_NATIVE_FUNCTION_DESCRIPTION",
-                Message.ID_VARIABLES: "ID_VARIABLES",
-                Message.ID_EXECUTION_STATE_CHANGED: "ID_EXECUTION_STATE_CHANGED",
-                Message.ID_NODE_PRESENT: "ID_NODE_PRESENT",
-                Message.ID_GET_DESCRIPTION: "ID_GET_DESCRIPTION",
-                Message.ID_SET_BYTECODE: "ID_SET_BYTECODE",
-                Message.ID_RESET: "ID_RESET",
-                Message.ID_RUN: "ID_RUN",
-                Message.ID_PAUSE: "ID_PAUSE",
-                Message.ID_STEP: "ID_STEP",
-                Message.ID_STOP: "ID_STOP",
-                Message.ID_GET_EXECUTION_STATE: "ID_GET_EXECUTION_STATE",
-                Message.ID_BREAKPOINT_SET: "ID_BREAKPOINT_SET",
-                Message.ID_BREAKPOINT_CLEAR: "ID_BREAKPOINT_CLEAR",
-                Message.ID_BREAKPOINT_CLEAR_ALL: "ID_BREAKPOINT_CLEAR_ALL",
-                Message.ID_GET_VARIABLES: "ID_GET_VARIABLES",
-                Message.ID_SET_VARIABLES: "ID_SET_VARIABLES",
-                Message.ID_GET_NODE_DESCRIPTION: "ID_GET_NODE_DESCRIPTION",
-                Message.ID_LIST_NODES: "ID_LIST_NODES",
-                Message.ID_GET_DEVICE_INFO: "ID_GET_DEVICE_INFO",
-                Message.ID_SET_DEVICE_INFO: "ID_SET_DEVICE_INFO",
-                Message.ID_GET_CHANGED_VARIABLES: "ID_GET_CHANGED_VARIABLES",
-                Message.ID_GET_NODE_DESCRIPTION_FRAGMENT: "ID_GET_NODE_DESCRIPTION_FRAGMENT",
-            }[id]
-        except KeyError:
-            return f"ID {id}"
+        return _id_to_str.get(id) or f"ID {id}"
 
     def __str__(self):
-        str = f"Message id={self.id_to_str(self.id)} src={self.source_node}"
+        s = f"Message id={self.id_to_str(self.id)} src={self.source_node}"
         if self.id == Message.ID_DESCRIPTION:
-            str += f" name={self.node_name}"
-            str += f" vers={self.protocol_version}"
-            str += f" bc_size={self.bytecode_size}"
-            str += f" stack_size={self.stack_size}"
-            str += f" max_var_size={self.max_var_size}"
-            str += f" #var={self.num_named_var}"
-            str += f" #ev={self.num_local_events}"
-            str += f" #nat={self.num_native_fun}"
+            s += f" name={self.node_name}"
+            s += f" vers={self.protocol_version}"
+            s += f" bc_size={self.bytecode_size}"
+            s += f" stack_size={self.stack_size}"
+            s += f" max_var_size={self.max_var_size}"
+            s += f" #var={self.num_named_var}"
+            s += f" #ev={self.num_local_events}"
+            s += f" #nat={self.num_native_fun}"
         elif self.id == Message.ID_NAMED_VARIABLE_DESCRIPTION:
-            str += f" name={self.var_name} size={self.var_size}"
+            s += f" name={self.var_name} size={self.var_size}"
         elif self.id == Message.ID_LOCAL_EVENT_DESCRIPTION:
-            str += f" name={self.event_name} descr={self.description}"
+            s += f" name={self.event_name} descr={self.description}"
         elif self.id == Message.ID_NATIVE_FUNCTION_DESCRIPTION:
-            str += f" name={self.fun_name} descr={self.description} p=("
-            for i in range(len(self.param_names)):
-                str += f"{self.param_names[i]}[{self.param_sizes[i] if self.param_sizes[i] != 65535 else '?'}],"
-            str += ")"
+            s += f" name={self.fun_name} descr={self.description} p=("
+            s += "".join(f"{name}[{size if size != 65535 else '?'}],"
+                         for name, size in zip(self.param_names, self.param_sizes))
+            s += ")"
         elif self.id == Message.ID_VARIABLES:
-            str += f" offset={self.var_offset} data=("
-            for word in self.var_data:
-                str += f"{word},"
-            str += ")"
+            s += f" offset={self.var_offset} data=("
+            s += "".join(f"{word}," for word in self.var_data)
+            s += ")"
         elif self.id == Message.ID_EXECUTION_STATE_CHANGED:
-            str += f" pc={self.pc} event_active={self.event_active} step_by_step={self.step_by_step} event_running={self.event_running}"
+            s += f" pc={self.pc} event_active={self.event_active} step_by_step={self.step_by_step} event_running={self.event_running}"
 
         elif self.id == Message.ID_NODE_PRESENT:
-            str += f" version={self.version}"
-        return str
+            s += f" version={self.version}"
+        return s
+
+
+# decoding method for each message id, for Message.decode
+_decoders = {
+    Message.ID_DESCRIPTION: Message.decode_description,
+    Message.ID_NAMED_VARIABLE_DESCRIPTION: Message.decode_named_variable_description,
+    Message.ID_LOCAL_EVENT_DESCRIPTION: Message.decode_local_event_description,
+    Message.ID_NATIVE_FUNCTION_DESCRIPTION: Message.decode_native_function_description,
+    Message.ID_VARIABLES: Message.decode_variables,
+    Message.ID_EXECUTION_STATE_CHANGED: Message.decode_execution_state_changed,
+    Message.ID_NODE_PRESENT: Message.decode_version,
+    Message.ID_DEVICE_INFO: Message.decode_device_info,
+    Message.ID_LIST_NODES: Message.decode_version,
+    Message.ID_GET_NODE_DESCRIPTION_FRAGMENT: Message.decode_get_node_description_fragment,
+}
+
+# decoding method for each message id, for Message.decode_inbound
+_inbound_decoders = dict(_decoders)
+
+_decoders.update({
+    Message.ID_SET_BYTECODE: Message.decode_set_bytecode,
+    Message.ID_BREAKPOINT_CLEAR_ALL: Message.decode_target_node,
+    Message.ID_RESET: Message.decode_target_node,
+    Message.ID_RUN: Message.decode_target_node,
+    Message.ID_PAUSE: Message.decode_target_node,
+    Message.ID_STEP: Message.decode_target_node,
+    Message.ID_STOP: Message.decode_target_node,
+    Message.ID_GET_EXECUTION_STATE: Message.decode_target_node,
+    Message.ID_BREAKPOINT_SET: Message.decode_breakpoint,
+    Message.ID_BREAKPOINT_CLEAR: Message.decode_breakpoint,
+    Message.ID_GET_VARIABLES: Message.decode_get_variables,
+    Message.ID_SET_VARIABLES: Message.decode_set_variables,
+})
+
+# message id to name string, for Message.id_to_str
+_id_to_str = {
+    Message.ID_DESCRIPTION: "DESCRIPTION",
+    Message.ID_NAMED_VARIABLE_DESCRIPTION: "ID_NAMED_VARIABLE_DESCRIPTION",
+    Message.ID_LOCAL_EVENT_DESCRIPTION: "ID_LOCAL_EVENT_DESCRIPTION",
+    Message.ID_NATIVE_FUNCTION_DESCRIPTION: "ID_NATIVE_FUNCTION_DESCRIPTION",
+    Message.ID_VARIABLES: "ID_VARIABLES",
+    Message.ID_EXECUTION_STATE_CHANGED: "ID_EXECUTION_STATE_CHANGED",
+    Message.ID_NODE_PRESENT: "ID_NODE_PRESENT",
+    Message.ID_GET_DESCRIPTION: "ID_GET_DESCRIPTION",
+    Message.ID_SET_BYTECODE: "ID_SET_BYTECODE",
+    Message.ID_RESET: "ID_RESET",
+    Message.ID_RUN: "ID_RUN",
+    Message.ID_PAUSE: "ID_PAUSE",
+    Message.ID_STEP: "ID_STEP",
+    Message.ID_STOP: "ID_STOP",
+    Message.ID_GET_EXECUTION_STATE: "ID_GET_EXECUTION_STATE",
+    Message.ID_BREAKPOINT_SET: "ID_BREAKPOINT_SET",
+    Message.ID_BREAKPOINT_CLEAR: "ID_BREAKPOINT_CLEAR",
+    Message.ID_BREAKPOINT_CLEAR_ALL: "ID_BREAKPOINT_CLEAR_ALL",
+    Message.ID_GET_VARIABLES: "ID_GET_VARIABLES",
+    Message.ID_SET_VARIABLES: "ID_SET_VARIABLES",
+    Message.ID_GET_NODE_DESCRIPTION: "ID_GET_NODE_DESCRIPTION",
+    Message.ID_LIST_NODES: "ID_LIST_NODES",
+    Message.ID_GET_DEVICE_INFO: "ID_GET_DEVICE_INFO",
+    Message.ID_SET_DEVICE_INFO: "ID_SET_DEVICE_INFO",
+    Message.ID_GET_CHANGED_VARIABLES: "ID_GET_CHANGED_VARIABLES",
+    Message.ID_GET_NODE_DESCRIPTION_FRAGMENT: "ID_GET_NODE_DESCRIPTION_FRAGMENT",
+}
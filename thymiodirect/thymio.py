@@ -15,10 +15,52 @@ import threading
 import time
 from typing import List
 
-from thymiodirect.connection import Connection
+from thymiodirect.connection import Connection, _is_array
 from thymiodirect.assembler import Assembler
 
 
+class ThymioNode:
+    """Access to the variables of a node by name, as returned by
+    Thymio.__getitem__.
+    """
+
+    __slots__ = ("thymio", "node_id")
+
+    def __init__(self, thymio: "Thymio", node_id: int):
+        self.thymio = thymio
+        self.node_id = node_id
+
+    def __getitem__(self, name):
+        try:
+            val = self.thymio.thymio_proxy.connection.get_var_array(self.node_id, name)
+            return val if len(val) != 1 else val[0]
+        except KeyError:
+            raise KeyError(name)
+
+    def get(self, name, index=0):
+        """Get the value of a scalar variable or of an item in an
+        array variable, without copying the whole array.
+        """
+        try:
+            return self.thymio.thymio_proxy.connection.get_var(self.node_id, name, index)
+        except KeyError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, val):
+        try:
+            if _is_array(val):
+                self.thymio.thymio_proxy.connection.set_var_array(self.node_id, name, val)
+            else:
+                self.thymio.thymio_proxy.connection.set_var(self.node_id, name, val)
+        except KeyError:
+            raise KeyError(name)
+
+    def update(self, values):
+        """Set several variables (dict name: value), sent together.
+        """
+        self.thymio.set_variables(self.node_id, values)
+
+
 class Thymio:
     """
     Thymio is a helper object for communicating with one or several Thymios
@@ -31,16 +73,17 @@ class Thymio:
         functions from asyncio coroutines.
         """
 
-        def __init__(self, thymio: "Thymio"):
+        def __init__(self, thymio: "Thymio", loop):
             """
             Construct a new __ThymioProxy object.
 
             :param thymio: Thymio object
+            :param loop: asyncio event loop of the thread
             """
 
             self.thymio = thymio
             self.connection = None
-            self.loop = asyncio.new_event_loop()
+            self.loop = loop
             self.nodes = set()
 
         def run(self):
@@ -54,11 +97,14 @@ class Thymio:
                 Do what's required when the Thymio connection changes.
                 """
                 if connected:
+                    self.thymio.remote_nodes[node_id] = self.connection.remote_nodes[node_id]
                     self.nodes.add(node_id)
+                    self.thymio.connected_event.set()
                     if self.thymio.on_connect_cb:
                         self.thymio.on_connect_cb(node_id)
                 else:
                     self.nodes.remove(node_id)
+                    self.thymio.remote_nodes.pop(node_id, None)
                     if self.thymio.on_disconnect_cb:
                         self.thymio.on_disconnect_cb(node_id)
 
@@ -92,12 +138,15 @@ class Thymio:
                                                          port=self.thymio.tcp_port,
                                                          discover_rate=self.thymio.discover_rate,
                                                          refreshing_rate=self.thymio.refreshing_rate,
+                                                         refreshing_rate_max=self.thymio.refreshing_rate_max,
                                                          refreshing_coverage=self.thymio.refreshing_coverage,
                                                          loop=self.loop)
                     else:
                         self.connection = Connection.serial(port=self.thymio.serial_port,
+                                                            low_latency=self.thymio.low_latency,
                                                             discover_rate=self.thymio.discover_rate,
                                                             refreshing_rate=self.thymio.refreshing_rate,
+                                                            refreshing_rate_max=self.thymio.refreshing_rate_max,
                                                             refreshing_coverage=self.thymio.refreshing_coverage,
                                                             loop=self.loop)
                     break
@@ -130,8 +179,10 @@ class Thymio:
                  on_disconnect=None,
                  on_comm_error=None,
                  refreshing_rate=0.1,
+                 refreshing_rate_max=None,
                  refreshing_coverage=None,
                  discover_rate=2,
+                 low_latency=False,
                  loop=None):
         self.use_tcp = use_tcp
         self.serial_port = serial_port
@@ -141,27 +192,39 @@ class Thymio:
         self.on_disconnect_cb = on_disconnect
         self.on_comm_error = on_comm_error
         self.refreshing_rate = refreshing_rate
+        self.refreshing_rate_max = refreshing_rate_max
         self.refreshing_coverage = refreshing_coverage
         self.discover_rate = discover_rate
-        self.loop = loop or asyncio.get_event_loop()
+        self.low_latency = low_latency
+        self.loop = loop
         self.thymio_proxy = None
         self.variable_observers = {}
         self.user_event_listeners = {}
+        self.node_proxies = {}  # key: node_id, value: ThymioNode
+        self.remote_nodes = {}  # key: node_id of connected nodes, value: RemoteNode
+        self.connected_event = threading.Event()  # set when a node is connected
 
     def connect(self, progress=None, delay=0.1):
         """Connect to Thymio or dongle.
         """
+        self.connected_event.clear()
+
         def thymio_thread():
-            asyncio.set_event_loop(asyncio.new_event_loop())
-            self.thymio_proxy = self._ThymioProxy(self)
-            self.thymio_proxy.run()
+            # single event loop for the thread, used by the connection
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            thymio_proxy = self._ThymioProxy(self, loop)
+            self.thymio_proxy = thymio_proxy
+            try:
+                thymio_proxy.run()
+            finally:
+                loop.close()
         self.thread = threading.Thread(target=thymio_thread)
         self.thread.start()
         if progress is None:
             progress = lambda: None
-        while self.thymio_proxy is None or len(self.thymio_proxy.nodes) == 0:
+        while not self.connected_event.wait(delay):
             progress()
-            time.sleep(delay)
 
     def disconnect(self):
         self.thymio_proxy.shutdown()
@@ -179,43 +242,37 @@ class Thymio:
     def variables(self, node_id):
         """Get list of variable names.
         """
-        node = self.thymio_proxy.connection.remote_nodes[node_id]
+        node = self.remote_nodes[node_id]
         return node.named_variables
 
     def variable_size(self, node_id, var_name):
         """Get the size of a variable.
         """
-        node = self.thymio_proxy.connection.remote_nodes[node_id]
+        node = self.remote_nodes[node_id]
         return node.var_size[var_name]
 
     def variable_offset(self, node_id, var_name):
         """Get the offset (address) of a variable.
         """
-        node = self.thymio_proxy.connection.remote_nodes[node_id]
+        node = self.remote_nodes[node_id]
         return node.var_offset[var_name]
 
     def __getitem__(self, key):
-        class Node:
-            def __init__(self_node, node_id):
-                self_node.node_id = node_id
-
-            def __getitem__(self_node, name):
-                try:
-                    val = self.thymio_proxy.connection.get_var_array(self_node.node_id, name)
-                    return val if len(val) != 1 else val[0]
-                except KeyError:
-                    raise KeyError(name)
-
-            def __setitem__(self_node, name, val):
-                try:
-                    if isinstance(val, list):
-                        self.thymio_proxy.connection.set_var_array(self_node.node_id, name, val)
-                    else:
-                        self.thymio_proxy.connection.set_var(self_node.node_id, name, val)
-                except KeyError:
-                    raise KeyError(name)
-
-        return Node(key)
+        node = self.node_proxies.get(key)
+        if node is None:
+            node = ThymioNode(self, key)
+            self.node_proxies[key] = node
+        return node
+
+    def set_variables(self, node_id, values):
+        """Set several variables at once (dict name: value, where value is a
+        scalar or a sequence), sending variables at consecutive addresses
+        together.
+        """
+        try:
+            self.thymio_proxy.connection.set_vars(node_id, values)
+        except KeyError as error:
+            raise KeyError(error.args[0])
 
     def set_variable_observer(self, node_id, observer):
         self.variable_observers[node_id] = observer
@@ -226,13 +283,13 @@ class Thymio:
     def events(self, node_id):
         """Get list of event names.
         """
-        node = self.thymio_proxy.connection.remote_nodes[node_id]
+        node = self.remote_nodes[node_id]
         return node.local_events
 
     def native_functions(self, node_id):
         """Get list of native function names and list of corresponding arg sizes.
         """
-        node = self.thymio_proxy.connection.remote_nodes[node_id]
+        node = self.remote_nodes[node_id]
         return (
             node.native_functions,
             [node.native_functions_arg_sizes[f] for f in node.native_functions]
@@ -242,7 +299,7 @@ class Thymio:
         """Assemble assembly code to bytecode, load it and run it.
         """
         # assemble program
-        remote_node = self.thymio_proxy.connection.remote_nodes[node_id]
+        remote_node = self.remote_nodes[node_id]
         a = Assembler(remote_node, asm)
         bc = a.assemble()
         # run it
@@ -251,9 +308,9 @@ class Thymio:
 
     def device_names(self):
         """Return a dict of node_id associated to their respective device name."""
-        return {node_id:self.thymio_proxy.connection.remote_nodes[node_id].device_name
+        return {node_id:self.remote_nodes[node_id].device_name
                 for node_id in self.nodes()}
 
     def device_name(self, node_id):
         """Return the device name for the given node_id."""
-        return self.thymio_proxy.connection.remote_nodes[node_id].device_name
+        return self.remote_nodes[node_id].device_name
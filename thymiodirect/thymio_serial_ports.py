@@ -61,19 +61,19 @@ class ThymioSerialPort:
         """Get the list of serial ports a Thymio is connected to.
         """
 
-        def check_hwid(hwid: str) -> Tuple[str, str]:
+        def check_hwid(hwid: str) -> Optional[Tuple[str, str]]:
             for vid, pid in USB_VID_PID:
                 if vid in hwid and pid in hwid:
                     return vid, pid
 
         try:
             from serial.tools.list_ports import comports
-            ports = [
-                ThymioSerialPort(port=port,
-                                 wireless=check_hwid(port.hwid)[1] == USB_PID_THYMIO_WIRELESS)
-                for port in comports()
-                if check_hwid(port.hwid)
-            ]
+            ports = []
+            for port in comports():
+                vid_pid = check_hwid(port.hwid)
+                if vid_pid:
+                    ports.append(ThymioSerialPort(port=port,
+                                                  wireless=vid_pid[1] == USB_PID_THYMIO_WIRELESS))
         except ValueError:
             # Probably thymiodirect.thymio_serial_ports isn't supported,
             # e.g. on macOS 11 as of December 2020